@@ -1,206 +1,865 @@
 # Command line app for maintaining a personal record of books (read, reading list, library, etc)
 # but could in principle be used for any media.
 
-import json
+import os
+import re
+import sys
+import threading
+import time
+from collections.abc import MutableSequence
+from contextlib import contextmanager
+from mnemosyne_autosave import Autosaver
+from mnemosyne_cache import QueryCache
+from mnemosyne_config import ConfigRegistry
+from mnemosyne_dedupe import DuplicateIndex
+from mnemosyne_index import LibraryIndex
+from mnemosyne_profile import Timings
+from mnemosyne_query import FIELD_ABBREVIATIONS, parse_query, run_query
+from mnemosyne_rank import RANKED_RESULTS, could_match, rank, rank_values, typo_fragments
+from mnemosyne_scan import matcher, scan
+from mnemosyne_record import as_record
+from mnemosyne_storage import JOURNAL_LIMIT, SYNC_EVERY, FORMAT_EXTENSIONS, MappedContents, MappedPositions, MappedRecords, find_library_file, is_binary_file, read_snapshot, write_snapshot, replay_journal, append_journal, remove_journal, fsync_directory, sync_journal, lock_library, read_generation, locked_generation, set_generation
+
+
+# Times Library.load() reads a library again when a commit from another process got in the way:
+LOAD_ATTEMPTS = 5
+
+# Entries shown per page of the display:
+DISPLAY_PAGE_SIZE = 50
+# Authors listed by the stats command:
+STATS_AUTHORS = 10
 
 
 class Library:
-    def __init__(self, name):
+    def __init__(self, name, storage='json', journal_limit=JOURNAL_LIMIT, file_format=None, durability='commit', sync_every=SYNC_EVERY, backups=0):
         self.name = name
-        self.filename = name+'.json'
+        # On-disk format ('pretty', 'compact' or 'binary', see mnemosyne_storage.py).
+        # Journal snapshots are compact by default, plain JSON libraries stay human-readable,
+        # and mmap storage only works on binary files:
+        if storage == 'mmap':
+            file_format = 'binary'
+        elif file_format is None:
+            file_format = 'compact' if storage == 'journal' else 'pretty'
+        self.file_format = file_format
+        self.filename = name + FORMAT_EXTENSIONS[file_format]
+        # File the library was read from (differs from filename until a format change is written out):
+        self.source_filename = self.filename
+        # Records in file order. Deleted records are left as None (tombstones) until the next full write.
+        # With mmap storage this is a MappedContents, which decodes records from the file as they are used.
         self.contents = []
+        # Every record carries a persistent '_id'. Maps id -> record and id -> position in contents:
+        self.records = {}
+        self.positions = {}
+        self.next_id = 0
+        self.tombstones = 0
+        # Search index keyed by record id (see mnemosyne_index.py). Each part of it is built by the first
+        # search that needs it, so opening a library never indexes anything:
+        self._index = LibraryIndex(self.records)
+        # Results of recent searches (see mnemosyne_cache.py):
+        self.cache = QueryCache()
+
+        # Storage engine ('json', 'journal' or 'mmap', see mnemosyne_storage.py):
+        self.storage = storage
+        self.journal_filename = name+'.journal'
+        self.journal_limit = journal_limit
+        # Identifies the snapshot the journal applies to:
+        self.snapshot_tag = None
+        # Set when records had to be given ids on load; the ids only stick once a full snapshot is written:
+        self.needs_snapshot = False
+        # Record-level changes since the last commit, in the order they were made:
+        self.changes = []
+        # 'commit': every commit is on disk when commit() returns.
+        # 'batch': commits are only forced to disk every sync_every commits (and by sync()), which is
+        # faster but can lose the last few commits in a power cut. Either way a crash never corrupts the library.
+        self.durability = durability
+        self.sync_every = sync_every
+        self.unsynced_commits = 0
+        # Number of previous versions of the library file to keep as <filename>.1, .2, ...:
+        self.backups = backups
+
+        # Other processes may commit to the same library (see mnemosyne_storage.py).
+        # generation is the value of the counter in the lock file when the library was last read or written:
+        self.lock_filename = name+'.lock'
+        self.generation = 0
+        self.lock_depth = 0
+        # Held from take_commit to the end of write_commit, and by commit, so commits are written one at a time and in order:
+        self.writer = threading.RLock()
+        # Old id -> new id for new records that had to be renumbered when merged with another process's
+        # changes (see merge), for updating the display:
+        self.renumbered = {}
+
+    # Reads the library from its files. Never waits for writers: if a commit happened while reading
+    # (the generation moved or was odd, i.e. mid-commit), it just reads again, a few times at most.
+    def load(self, index=True):
+        for attempt in range(LOAD_ATTEMPTS):
+            generation = read_generation(self.lock_filename)
+            try:
+                self.read_files(index)
+            except FileNotFoundError:
+                # A format conversion removed the file between finding and reading it:
+                if attempt == LOAD_ATTEMPTS - 1:
+                    raise
+                continue
+            if generation % 2 == 0 and read_generation(self.lock_filename) == generation:
+                break
+        self.generation = generation
+
+    def read_files(self, index):
+        if isinstance(self.contents, MappedContents):
+            self.contents.close()
+        self.needs_snapshot = False
+        self.source_filename = find_library_file(self.name, self.file_format)
+        if self.storage == 'mmap' and is_binary_file(self.source_filename):
+            self.map_contents()
+        else:
+            contents, self.snapshot_tag = read_snapshot(self.source_filename)
+            self.load_contents(replay_journal(self.journal_filename, contents, self.snapshot_tag), index)
+        # Convert to the configured format on the next commit:
+        if self.source_filename != self.filename:
+            self.needs_snapshot = True
+
+    # Holds the library's lock while writing to its files. If another process committed since this
+    # one read the library, the uncommitted changes are merged onto the newer state first.
+    # The generation is odd while a commit is in progress, so readers know to read again.
+    # With merge=False (see write_commit) nothing is merged: the context gives False instead, and
+    # nothing should be written.
+    @contextmanager
+    def writing(self, merge=True):
+        if self.lock_depth:
+            yield True
+            return
+        lock_file = lock_library(self.lock_filename)
+        self.lock_depth = 1
+        try:
+            generation = locked_generation(lock_file)
+            if generation != self.generation:
+                if not merge:
+                    yield False
+                    return
+                self.merge()
+            # An odd generation left by a crashed commit is simply moved past:
+            generation += 1 if generation % 2 == 0 else 2
+            set_generation(lock_file, generation)
+            yield True
+            set_generation(lock_file, generation + 1)
+            self.generation = generation + 1
+        finally:
+            self.lock_depth = 0
+            lock_file.close()
+
+    # Rereads the library and replays this session's uncommitted changes on top, record by record:
+    # edits and deletions apply to the current version of each record, so only records both sides
+    # changed are decided by this (later) commit. New records get fresh ids if theirs were taken,
+    # and an edit to a record the other side deleted is kept as a new record.
+    # This runs under the lock, so the search index is not rebuilt here but by the next search.
+    def merge(self):
+        local_changes = self.changes
+        self.load(index=False)
+        self.changes = []
+        renumbered = {}
+        for change in local_changes:
+            if change['op'] == 'insert':
+                old_id = change['record']['_id']
+                renumbered[old_id] = self.insert_entry(change['record'])
+                continue
+            record_id = renumbered.get(change['id'], change['id'])
+            if change['op'] == 'update':
+                if record_id in self.records:
+                    self.update_entry(record_id, change['record'])
+                else:
+                    renumbered[change['id']] = self.insert_entry(change['record'])
+            elif change['op'] == 'delete' and record_id in self.records:
+                self.delete_entry(record_id)
+        self.renumbered.update({old_id: new_id for old_id, new_id in renumbered.items() if old_id != new_id})
+
+    # Takes over a list of records read from storage and assigns ids to any that don't have one yet:
+    def load_contents(self, contents, index=True):
+        self.contents = [as_record(record) for record in contents if record is not None]
+        self.records = {}
+        self.positions = {}
+        self.tombstones = 0
+        self.cache.clear()
+        self.next_id = max((record.get('_id', -1) for record in self.contents), default=-1) + 1
+        for position, record in enumerate(self.contents):
+            # Records added by hand or by older versions have no id, and copied records may share one:
+            if '_id' not in record or record['_id'] in self.records:
+                record['_id'] = self.next_id
+                self.next_id += 1
+                self.needs_snapshot = True
+            self.records[record['_id']] = record
+            self.positions[record['_id']] = position
+        # Without index even the (empty) search index is left to the first search:
+        if index:
+            self.build_index()
+        else:
+            self._index = None
+
+    # Maps a binary snapshot instead of reading it. Nothing is decoded here, so this takes the
+    # same time however large the library is; the search index is only built by the first search.
+    def map_contents(self):
+        self.contents = MappedContents(self.source_filename)
+        self.records = MappedRecords(self.contents)
+        self.positions = MappedPositions(self.contents)
+        self.snapshot_tag = self.contents.tag
+        replay_journal(self.journal_filename, self.contents, self.snapshot_tag, self.positions)
+        self.tombstones = len(self.contents.deleted_ids)
+        self.cache.clear()
+        self.next_id = self.contents.max_id() + 1
+        self._index = None
+
+    # Mapped libraries are searched by scanning the map: an index would have to decode every record
+    # and keep what it needs of them in memory, which is what mapping the file avoids.
+    @property
+    def mapped(self):
+        return isinstance(self.contents, MappedContents)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self.build_index()
+        return self._index
+
+    def build_index(self):
+        self._index = LibraryIndex(self.records)
+
+    # Drops tombstones from contents (O(n), so only done when the whole library is written anyway).
+    # Mapped contents drop them when they are rewritten.
+    def compact_contents(self):
+        if self.tombstones and not isinstance(self.contents, MappedContents):
+            self.contents = [record for record in self.contents if record is not None]
+            self.positions = {record['_id']: position for position, record in enumerate(self.contents)}
+            self.tombstones = 0
 
     def commit(self):
-        with open(self.filename,'w') as jsonfile:
-            json.dump(self.contents,jsonfile,indent=4)
+        with self.writer:
+            if not self.changes and not self.needs_snapshot:
+                return
+            with timings.timed('commit'), self.writing():
+                if self.storage in ('journal', 'mmap') and not self.needs_snapshot:
+                    if self.append_changes(self.changes):
+                        self.compact()
+                else:
+                    self.compact()
+            self.changes = []
+
+    # Background saves (see mnemosyne_autosave.py) commit in two steps, so that commands only wait
+    # for the first. take_commit() needs the library to itself: it takes the changes since the last
+    # commit, plus a copy of the records for a full write, and returns them for write_commit(),
+    # which writes them while commands go on changing the library.
+    # Commits that change the library itself (merging another process's commits, a change of
+    # format, rewriting a mapped file) are done in full by take_commit(), which then returns None.
+    def take_commit(self):
+        if not self.changes and not self.needs_snapshot:
+            return None
+        appending = self.storage in ('journal', 'mmap') and not self.needs_snapshot
+        if read_generation(self.lock_filename) != self.generation or self.source_filename != self.filename or (self.mapped and not appending):
+            self.commit()
+            return None
+        self.writer.acquire()
+        changes = self.changes
+        self.changes = []
+        if appending:
+            return changes, None
+        # Records are never changed in place (see Text.edit), so a copy of the list is a snapshot:
+        self.compact_contents()
+        return changes, list(self.contents)
+
+    # Returns False, with nothing written, if another process committed since take_commit():
+    # the changes are pending again and have to be merged by commit(). They are also pending again
+    # if writing fails.
+    def write_commit(self, taken):
+        changes, contents = taken
+        written = False
+        try:
+            with timings.timed('commit'), self.writing(merge=False) as current:
+                if current and contents is None:
+                    # A journal that has grown too long is folded into a snapshot by the next commit:
+                    if self.append_changes(changes):
+                        self.needs_snapshot = True
+                elif current:
+                    self.write_snapshot(contents=contents)
+                written = current
+        finally:
+            if not written:
+                # Put back ahead of changes made meanwhile (a single slice assignment, so no
+                # change appended by a command at the same time is lost):
+                self.changes[:0] = changes
+            self.writer.release()
+        return written
+
+    # Appends changes to the journal. Returns whether the journal should now be folded into a snapshot:
+    def append_changes(self, changes):
+        sync = self.durability == 'commit' or self.unsynced_commits + 1 >= self.sync_every
+        journal_size = append_journal(self.journal_filename, changes, self.snapshot_tag, sync)
+        self.unsynced_commits = 0 if sync else self.unsynced_commits + 1
+        return journal_size > self.journal_limit or self.tombstones > len(self.contents) // 2
+
+    # Writes the whole library out as a fresh snapshot and folds in any journal.
+    # file_format overrides the library's own format for this write (export uses 'pretty').
+    def compact(self, file_format=None):
+        with self.writer, self.writing():
+            self.write_snapshot(file_format)
+            self.changes = []
+
+    # contents, if given, is the copy of the records taken by take_commit().
+    def write_snapshot(self, file_format=None, contents=None):
+        file_format = file_format or self.file_format
+        if contents is None:
+            self.compact_contents()
+            contents = self.contents
+        # A snapshot that replaces a journal always has to be durable before the journal goes:
+        sync = self.durability == 'commit' or self.storage != 'json' or self.unsynced_commits + 1 >= self.sync_every
+        if isinstance(contents, MappedContents) and file_format == 'binary':
+            self.snapshot_tag = contents.rewrite(self.filename, self.backups, sync)
+            self.tombstones = 0
+        else:
+            self.snapshot_tag = write_snapshot(self.filename, contents, file_format, backups=self.backups, sync=sync)
+        self.unsynced_commits = 0 if sync else self.unsynced_commits + 1
+        remove_journal(self.journal_filename)
+        # The file in the old format is superseded once the library has been written in the new one:
+        if self.source_filename != self.filename:
+            os.remove(self.source_filename)
+            self.source_filename = self.filename
+        self.needs_snapshot = False
+
+    # Forces any commits not yet on disk (with 'batch' durability) to disk:
+    def sync(self):
+        with self.writer:
+            if self.unsynced_commits:
+                if self.storage == 'json':
+                    fsync_directory(self.filename)
+                else:
+                    sync_journal(self.journal_filename)
+                self.unsynced_commits = 0
+
+    def insert_entry(self, record):
+        record = as_record(record)
+        record['_id'] = self.next_id
+        self.next_id += 1
+        self.records[record['_id']] = record
+        self.positions[record['_id']] = len(self.contents)
+        self.contents.append(record)
+        # A search index that hasn't been built yet will pick up the change when it is:
+        if self._index is not None:
+            self._index.add(record['_id'], record)
+        self.cache.invalidate(record['_id'], record)
+        self.changes.append({'op':'insert','record':record})
+        return record['_id']
+
+    def update_entry(self, record_id, record):
+        record = as_record(record)
+        record['_id'] = record_id
+        old_record = self.records[record_id] if self._index is not None else None
+        self.records[record_id] = record
+        self.contents[self.positions[record_id]] = record
+        if self._index is not None:
+            self._index.update(record_id, old_record, record)
+        self.cache.invalidate(record_id, record)
+        self.changes.append({'op':'update','id':record_id,'record':record})
+
+    def delete_entry(self, record_id):
+        old_record = self.records[record_id] if self._index is not None else None
+        del self.records[record_id]
+        self.contents[self.positions.pop(record_id)] = None
+        self.tombstones += 1
+        if self._index is not None:
+            self._index.remove(record_id, old_record)
+        self.cache.invalidate(record_id)
+        self.changes.append({'op':'delete','id':record_id})
+
+# A library kept in an SQLite database (storage 'sqlite', see mnemosyne_sqlite.py).
+# The records stay in the database: contents, records and positions are views that query it,
+# searches, sorted listings and counts run as SQL, and changes are written as they are made, to be
+# made permanent by commit(). SQLite does its own locking, so there is no lock file or merging.
+# mnemosyne_sqlite (and sqlite3) are only imported once an SQLite library is used.
+class SqliteLibrary(Library):
+    def __init__(self, name, durability='commit', sync_every=SYNC_EVERY):
+        from mnemosyne_sqlite import SQLITE_EXTENSION
+        super().__init__(name, 'sqlite', durability=durability, sync_every=sync_every)
+        self.file_format = 'sqlite'
+        self.filename = name + SQLITE_EXTENSION
+        self.source_filename = self.filename
+        self.store = None
+        self._index = None
+
+    def load(self, index=True):
+        from mnemosyne_sqlite import SqliteStore, SqliteContents, SqlitePositions, SqliteRecords
+        if self.store is None:
+            if not os.path.exists(self.filename):
+                raise FileNotFoundError(self.filename)
+            self.store = SqliteStore(self.filename, self.durability)
+        self.contents = SqliteContents(self.store)
+        self.records = SqliteRecords(self.store)
+        self.positions = SqlitePositions(self.store)
+        self.cache.clear()
+
+    @contextmanager
+    def writing(self):
+        yield
 
-    def delete_entry(self, index):
-        self.contents.pop(index)
+    def commit(self):
+        if not self.changes:
+            return
+        with timings.timed('commit'):
+            self.store.commit()
+        self.changes = []
+        if self.durability == 'batch':
+            self.unsynced_commits += 1
+            if self.unsynced_commits >= self.sync_every:
+                self.sync()
+
+    # Changes are written to the database as they are made, so there is nothing to take for a
+    # background save (see Library.take_commit):
+    def take_commit(self):
+        self.commit()
+        return None
+
+    # There is no snapshot to write: compacting reclaims the space of deleted records instead.
+    def compact(self, file_format=None):
+        self.commit()
+        self.store.vacuum()
+
+    def sync(self):
+        if self.unsynced_commits:
+            self.store.checkpoint()
+            self.unsynced_commits = 0
+
+    def insert_entry(self, record):
+        record = as_record(record)
+        record['_id'] = self.store.insert(record)
+        self.cache.invalidate(record['_id'], record)
+        self.changes.append({'op':'insert','record':record})
+        return record['_id']
+
+    def update_entry(self, record_id, record):
+        record = as_record(record)
+        record['_id'] = record_id
+        self.store.update(record_id, record)
+        self.cache.invalidate(record_id, record)
+        self.changes.append({'op':'update','id':record_id,'record':record})
+
+    def delete_entry(self, record_id):
+        if not self.store.delete(record_id):
+            raise KeyError(record_id)
+        self.cache.invalidate(record_id)
+        self.changes.append({'op':'delete','id':record_id})
+
+
+# The libraries in config.json, read once and reloaded only when the file changes:
+config_registry = ConfigRegistry()
+
+# Times and counters for the stats command (see mnemosyne_profile.py):
+timings = Timings()
+
+# Returns the config.json entry for a library (empty if it isn't registered):
+def library_settings(library_name):
+    return config_registry.get(library_name) or {}
 
 # Called by call_librarian() when user attempts to open a library:
 # Acts as a gate to block open_library from accepting invalid filenames
 def check_valid_library(library_name):
-# Check if library_name points to valid Mnemosyne library:
-    with open('config.json','r') as config_file:
-        config = json.load(config_file)
-        for entry in config:
-            if entry['name'] == library_name:
-                return True
-    return False
-
-def open_library(library_name):
-    library = Library(library_name)
-    with open(library.filename,'r') as library_file:
-        library.contents = json.load(library_file)
+    return library_name in config_registry
+
+def open_library(library_name, index=True):
+    settings = library_settings(library_name)
+    if settings.get('storage') == 'sqlite':
+        library = SqliteLibrary(library_name, settings.get('durability','commit'), settings.get('sync_every',SYNC_EVERY))
+        with timings.timed('load'):
+            library.load(index)
+        return library
+    library = Library(library_name, settings.get('storage','json'), settings.get('journal_limit',JOURNAL_LIMIT), settings.get('format'),
+        settings.get('durability','commit'), settings.get('sync_every',SYNC_EVERY), settings.get('backups',0))
+    with timings.timed('load'):
+        library.load(index)
     return library
+
+# Writes the library out in the standard pretty JSON format.
+# Exporting to the library's own file folds any journal into it.
+def export_library(library, filename):
+    if filename == library.filename:
+        library.compact('pretty')
+    else:
+        write_snapshot(filename, library.contents, 'pretty')
     
 def set_default_library(library_name):
-    with open('config.json','r') as config_file:
-        config = json.load(config_file)
-        for entry in config:
-            if entry['name'] == library_name:
-                entry['is_default'] = True
-            else:
-                entry['is_default'] = False
-    with open('config.json','w') as config_file:
-        json.dump(config,config_file,indent=4)
+    config_registry.set_default(library_name)
 
 
 # Basic class for reading/writing records to/from library.json
 # Instance corresponds to a single record pulled from/to be written to library.json
 class Text:
+    __slots__ = ('id', 'info', 'library')
+
     def __init__(self):
-        # Index of entry in library.json
-        # Defaults to -1 for new entries, which are appended to the end of the library with write_to_library()
-        self.index = -1
+        # Id of the record in the library (stays valid when other records are deleted)
+        # Defaults to None for new entries, which are appended to the end of the library with write_to_library()
+        self.id = None
 
         # Matches JSON library structure:
         self.info = {}
 
+        # Name of the library the record came from, for searchall results from several libraries.
+        # None means the current library.
+        self.library = None
+
     def __repr__(self):
         return f'{self.info["Title"]} by {self.info["Attribution"]}'
 
+    # Edits a copy of the record, so the record stored in the library (and indexed by its old
+    # fields, see mnemosyne_index.py) only changes when write_to_library stores the copy:
     def edit(self, field, entry):
+        self.info = self.info.copy()
         self.info[field] = entry
         return self
 
 
+# The display: the texts the librarian has retrieved, numbered from 0, and the page being shown.
+# Search results go in as record ids of library, and each one only becomes a Text when it is looked
+# at (shown on a page, opened, edited...), so a search with a huge number of hits returns straight away.
+# A record deleted (by another process, say) before it is looked at raises KeyError instead.
+class Display(MutableSequence):
+    def __init__(self, entries=(), library=None):
+        # Texts, and record ids of library for the entries not looked at yet:
+        self.entries = list(entries)
+        self.library = library
+        self.page = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[number] for number in range(*index.indices(len(self.entries)))]
+        entry = self.entries[index]
+        if type(entry) is int:
+            text = Text()
+            # KeyError if the record is gone:
+            text.info = self.library.records[entry]
+            text.id = entry
+            self.entries[index] = entry = text
+            timings.count('texts built')
+        return entry
+
+    def __setitem__(self, index, text):
+        self.entries[index] = text
+
+    def __delitem__(self, index):
+        del self.entries[index]
+
+    def insert(self, index, text):
+        self.entries.insert(index, text)
+
+    # The texts in order, leaving out records that are gone:
+    def __iter__(self):
+        for index in range(len(self.entries)):
+            try:
+                yield self[index]
+            except KeyError:
+                continue
+
+    # Entries from the same library stay unbuilt; those from another library are built first:
+    def __iadd__(self, other):
+        if self.library is None or other.library is None or other.library is self.library:
+            self.library = self.library or other.library
+            self.entries.extend(other.entries)
+        else:
+            self.entries.extend(other)
+        return self
+
+    def __add__(self, other):
+        combined = Display(self.entries, self.library)
+        combined += other
+        return combined
+
+    def pages(self):
+        return max(1, -(-len(self.entries) // DISPLAY_PAGE_SIZE))
+
+    # Id and library name (None for the current library) of every entry, without building Texts:
+    def sources(self):
+        for entry in self.entries:
+            if type(entry) is int:
+                yield entry, None
+            else:
+                yield entry.id, entry.library
+
+    # Gives the entry at index a new record id:
+    def renumber(self, index, record_id):
+        if type(self.entries[index]) is int:
+            self.entries[index] = record_id
+        else:
+            self.entries[index].id = record_id
+
+    # Drops every entry for a record (given by id and library name):
+    def discard(self, record_id, library_name, current_name):
+        self.entries = [entry for entry, (entry_id, entry_library) in zip(self.entries, self.sources())
+            if entry_id != record_id or (entry_library or current_name) != library_name]
+        self.page = min(self.page, self.pages() - 1)
+
+# Builds the display for a list of record ids:
+def found_texts(record_ids, library):
+    return Display(record_ids, library)
+
+# Searches are answered from the library's query cache when they have been run before.
+# Each cached result is stored with a function telling whether a record matches the search,
+# so that the result is dropped as soon as a record it could contain changes (see mnemosyne_cache.py).
+
 def browse(field, query, library):
-    findings = []
     # Rating searches get special code because ints break the in keyword.
     if field == 'Rating':
         query = int(query)
-        for (index, record) in enumerate(library.contents):
-            if query == record[field]:
-                find = Text()
-                find.info = record
-                find.index = index
-                findings.append(find)
-    # Code for all other searches:
+        matches = lambda record: record['Rating'] == query
+    else:
+        query = query.lower()
+        matches = lambda record: query in record[field].lower()
+    key = ('search', field, query)
+    record_ids = library.cache.get(key)
+    if record_ids is None:
+        with timings.timed('match'):
+            record_ids = search_ids(field, query, library)
+        library.cache.put(key, record_ids, matches)
+    return found_texts(record_ids, library)
+
+def search_ids(field, query, library):
+    if library.storage == 'sqlite':
+        return library.store.search(field, query)
+    if library.mapped:
+        if field == 'Rating':
+            return [record['_id'] for record in library.contents if record is not None and record['Rating'] == query]
+        return [library.contents[position]['_id'] for position in scan(library.contents, field, query)]
+    if field == 'Rating':
+        return sorted(library.index.ratings.lookup(query), key=library.positions.__getitem__)
+    # Only check the records the index can't rule out.
+    # Queries without any word characters can't use the index and fall back to a full scan.
+    candidates = library.index.field(field).candidates(query)
+    if candidates is None:
+        return [library.contents[position]['_id'] for position in scan(library.contents, field, query)]
+    # Keep results in library order:
+    candidates = sorted(candidates, key=library.positions.__getitem__)
+    query = query.lower()
+    return [record_id for record_id in candidates if query in library.records[record_id][field].lower()]
+
+# Searches by scanning every record, in parallel for big libraries (see mnemosyne_scan.py).
+# For queries the index can't help with: substrings without word characters, regular expressions.
+# Raises re.error if regex is set and query isn't a valid regular expression.
+def browse_scan(field, query, library, regex=False):
+    key = ('regex' if regex else 'search', field, query if regex else query.lower())
+    record_ids = library.cache.get(key)
+    if record_ids is None:
+        field_matches = matcher(query, regex)
+        with timings.timed('match'):
+            if library.storage == 'sqlite':
+                record_ids = library.store.filter(field, field_matches)
+            else:
+                record_ids = [library.contents[position]['_id'] for position in scan(library.contents, field, query, regex)]
+        library.cache.put(key, record_ids, lambda record: bool(field_matches(str(record[field]))))
+    return found_texts(record_ids, library)
+
+# Returns the records matching a parsed compound query (see mnemosyne_query.py), in library order:
+def browse_query(query, library):
+    key = ('query', query.key())
+    record_ids = library.cache.get(key)
+    if record_ids is None:
+        with timings.timed('match'):
+            if library.storage == 'sqlite':
+                record_ids = library.store.query(query)
+            elif library.mapped:
+                record_ids = [record['_id'] for record in library.contents if record is not None and query.matches(record)]
+            else:
+                record_ids = run_query(query, library)
+        library.cache.put(key, record_ids, query.matches)
+    return found_texts(record_ids, library)
+
+# Returns the best matches for query, best first (at most RANKED_RESULTS, see mnemosyne_rank.py):
+def browse_ranked(field, query, library, k=RANKED_RESULTS):
+    key = ('ranked', field, query.lower(), k)
+    record_ids = library.cache.get(key)
+    if record_ids is None:
+        with timings.timed('match'):
+            if library.storage == 'sqlite':
+                record_ids = rank_values(library.store.values_containing(field, typo_fragments(query)), query, k)
+            elif library.mapped:
+                record_ids = rank_values(scan_values_containing(field, typo_fragments(query), library), query, k)
+            else:
+                record_ids = rank(field, query, library, k)
+        library.cache.put(key, record_ids, lambda record: could_match(record[field], query))
+    return found_texts(record_ids, library)
+
+# (id, value of field) for the records of a mapped library whose field contains any of fragments
+# (every record if there are none), in library order, found by scanning the map:
+def scan_values_containing(field, fragments, library):
+    contents = library.contents
+    if fragments:
+        positions = scan(contents, field, '|'.join(re.escape(fragment) for fragment in fragments), regex=True)
     else:
-        for (index, record) in enumerate(library.contents):
-            if query.lower() in record[field].lower():
+        positions = [position for position in range(len(contents)) if contents[position] is not None]
+    return [(record['_id'], record[field]) for record in map(contents.__getitem__, positions)]
+
+# Searches one library straight from its files, in a search_all() worker process.
+# A one-off search doesn't pay for building the index: the records are just scanned.
+def scan_library(library_name, field, query):
+    library = open_library(library_name, index=False)
+    if library.storage == 'sqlite':
+        return [library.records[record_id] for record_id in library.store.search(field, int(query) if field == 'Rating' else query)]
+    if field == 'Rating':
+        query = int(query)
+        return [record for record in library.contents if record is not None and record['Rating'] == query]
+    query = query.lower()
+    return [record for record in library.contents if record is not None and query in record[field].lower()]
+
+# Searches every library in config.json. The other libraries are read and scanned in parallel worker
+# processes while the current library (which may have uncommitted changes) is searched here with its index.
+# Results come in config.json order, each library's in library order, and are tagged with their library.
+def search_all(field, query, current_library=None):
+    library_names = config_registry.names()
+    other_names = [name for name in library_names if not current_library or name != current_library.name]
+    results = {}
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=max(1, min(len(other_names), os.cpu_count() or 1))) as pool:
+        futures = {name: pool.submit(scan_library, name, field, query) for name in other_names}
+        if current_library:
+            results[current_library.name] = browse(field, query, current_library)
+        for name, future in futures.items():
+            try:
+                records = future.result()
+            except FileNotFoundError:
+                print(f'Error: Cannot find library {name}.')
+                continue
+            results[name] = []
+            for record in records:
                 find = Text()
                 find.info = record
-                find.index = index
-                findings.append(find)
+                find.id = record['_id']
+                results[name].append(find)
+    findings = Display()
+    for name in library_names:
+        for find in results.get(name, []):
+            find.library = name
+            findings.append(find)
     return findings
 
+# Returns the records of library in order of field, as a display (see SortedIndex in mnemosyne_index.py).
+# The order is kept up to date as records change, so a listing only copies it.
+def sorted_texts(field, library, descending=False):
+    if library.storage == 'sqlite':
+        return found_texts(library.store.sorted_ids(field, descending), library)
+    sorted_index = library.index.sorted_by(field)
+    return found_texts(reversed(sorted_index.keys) if descending else sorted_index.keys, library)
+
+# Returns the groups of possible duplicate records in library (see mnemosyne_dedupe.py), each group
+# in library order, ordered by their first record:
+def find_duplicates(library):
+    with timings.timed('dedupe'):
+        duplicates = DuplicateIndex(record for record in library.contents if record is not None)
+        groups = [sorted(group, key=library.positions.__getitem__) for group in duplicates.clusters()]
+    groups.sort(key=lambda group: library.positions[group[0]])
+    return groups
+
+# Returns the library a displayed text should be written back to.
+# Texts from other libraries (searchall results) get their library opened for the change.
+def library_of(text, current_library):
+    if text.library is None or (current_library and text.library == current_library.name):
+        return current_library
+    return open_library(text.library, index=False)
+
+# Points displayed texts at the new ids of records that were renumbered when a commit was merged
+# with another process's changes (see Library.merge):
+def renumber_display(display, library, current_library):
+    if not library.renumbered:
+        return
+    current_name = current_library.name if current_library else None
+    for index, (record_id, library_name) in enumerate(display.sources()):
+        if (library_name or current_name) == library.name and record_id in library.renumbered:
+            display.renumber(index, library.renumbered[record_id])
+    library.renumbered = {}
+
 def write_to_library(new_record, library):
-    if new_record.index == -1:
-        library.contents.append(new_record.info)
+    if new_record.id is None:
+        new_record.id = library.insert_entry(new_record.info)
     else:
-        library.contents[new_record.index] = new_record.info
+        library.update_entry(new_record.id, new_record.info)
+    # New and edited entries are stored as Records; keep the Text pointing at the stored one:
+    new_record.info = library.records[new_record.id]
 
 
 # Command line interface/GUI stuff:
-
-import tkinter as tk
-
-class InputWindow(tk.Tk):
-    def __init__(self, existing_entry=''):
-        super().__init__()
-        self.title('Input Window')
-
-        self.label = tk.Label(self, text='Enter your input:')
-        self.label.pack()
-
-        self.entry = tk.Text(self)
-        self.entry.insert(tk.END, existing_entry)
-        self.entry.pack()
-
-        self.button = tk.Button(self, text='Done', command=self.save_input)
-        self.button.pack()
-
-    def save_input(self):
-        self.new_field_entry = self.entry.get(1.0,'end').strip()
-        # strip() to remove newline automatically added by tk.Text
-        self.destroy()
-
-class NewTextWindow(tk.Tk):
-    def __init__(self, title):
-        super().__init__()
-        self.title(title)
-
-        self.label = tk.Label(self, text='Enter new text info:')
-        self.label.pack()
-
-        self.text_title = tk.Entry(self)
-        self.text_title.pack()
-
-        self.attribution = tk.Entry(self)
-        self.attribution.pack()
-
-        self.rating = tk.Entry(self)
-        self.rating.pack()
-
-        self.edition_notes = tk.Text(self)
-        self.edition_notes.pack()
-
-        self.comments = tk.Text(self)
-        self.comments.pack()
-
-        self.button = tk.Button(self, text='Done', command=self.save_input)
-        self.button.pack()
-
-    def save_input(self):
-        self.new_title = self.text_title.get()
-        self.new_attribution = self.attribution.get()
-        self.new_rating = self.rating.get()
-        self.new_edition_notes = self.edition_notes.get(1.0,'end').strip()
-        self.new_comments = self.comments.get(1.0,'end').strip()
-        # strip() to remove newline automatically added by tk.Text
-        self.destroy()
-
-class ErrorWindow(tk.Tk):
-    def __init__(self, error):
-        super().__init__()
-        self.title('Error')
-
-        self.label = tk.Label(self, text=error)
-        self.label.pack()
-
-        self.button = tk.Button(self, text='Okay', command=self.destroy)
-        self.button.pack()
-
-# Create an instance of the InputWindow class:
-# input_window = InputWindow()
-# input_window.mainloop()
-# Access the user input after the window is closed:
-# print("User input:", input_window.new_field_entry)
+# The Tk windows live in mnemosyne_gui.py and are only imported when a window is actually opened,
+# so scripts that just use the library functions never load tkinter.
 
 def create_library(name):
     new_library = Library(name)
     # Save to file:
-    with open(new_library.filename,'w') as new_library_file:
-        json.dump(new_library.contents,new_library_file,indent=4)
-    # Add to config:
-    with open('config.json','r') as config_file:
-        config = json.load(config_file)
-        # If config is currently empty, add as default library:
-        if len(config) == 0:
-            config.append({'name':name,'is_default':True})
-        # Else add as non-default library:
-        else:
-            config.append({'name':name,'is_default':False})
-    with open('config.json','w') as config_file:
-        json.dump(config,config_file,indent=4)
+    write_snapshot(new_library.filename, new_library.contents, new_library.file_format)
+    # Add to config (as the default library if it is the first one):
+    config_registry.add(name)
     return open_library(name)
 
+# Moves a library to another storage engine ('json', 'journal', 'mmap' or 'sqlite') and returns it
+# reopened. The records keep their ids. Moving to or from sqlite leaves the old file in place as a backup.
+# Raises ValueError if the library already uses that engine or a file for it is in the way.
+def migrate_library(library, storage):
+    if storage == library.storage:
+        raise ValueError(f'{library.name} already uses {storage} storage')
+    library.commit()
+    library.sync()
+    if storage == 'sqlite':
+        from mnemosyne_sqlite import SQLITE_EXTENSION, SqliteStore
+        filename = library.name + SQLITE_EXTENSION
+        if os.path.exists(filename):
+            raise ValueError(f'{filename} already exists')
+        store = SqliteStore(filename)
+        store.bulk_load(library.contents)
+        store.close()
+        config_registry.update(library.name, storage='sqlite', format=None)
+    else:
+        file_format = 'binary' if storage == 'mmap' else 'compact' if storage == 'journal' else 'pretty'
+        config_registry.update(library.name, storage=storage, format=file_format)
+        if library.storage == 'sqlite':
+            write_snapshot(library.name + FORMAT_EXTENSIONS[file_format], library.contents, file_format)
+            # A journal left from before the library moved to sqlite belongs to an older snapshot:
+            remove_journal(library.journal_filename)
+        # Between the file engines the library is just written out again in its new format:
+        else:
+            migrated_library = open_library(library.name)
+            migrated_library.compact()
+            return migrated_library
+    return open_library(library.name)
+
 # For parsing abbreviations in the command line:
 def fieldparser(abbreviation):
-    if abbreviation not in ('t','a','n','c','r'):
+    if abbreviation not in FIELD_ABBREVIATIONS:
         raise ValueError('invalid field abbreviation')
-    field_parser_key = {
-        't':'Title',
-        'a':'Attribution',
-        'n':'Edition Notes',
-        'c':'Comments',
-        'r':'Rating'
-        }
-    field = field_parser_key[abbreviation]
+    field = FIELD_ABBREVIATIONS[abbreviation]
     return field
 
+# For batch mode, where field values are given inline instead of through a window:
+# "t:The Hobbit | a:J. R. R. Tolkien | r:5 | c:First line\nSecond line"
+# Raises ValueError with a message for the user if any value is invalid.
+def parse_field_values(text):
+    values = {}
+    for segment in text.split('|'):
+        if len(segment.strip()) == 0:
+            continue
+        abbreviation, separator, entry = segment.partition(':')
+        if not separator:
+            raise ValueError('Invalid parameter (expected field:value).')
+        try:
+            field = fieldparser(abbreviation.strip())
+        except ValueError:
+            raise ValueError('Invalid parameter (field abbreviation).')
+        entry = entry.strip().replace('\\n','\n')
+        if field == 'Rating':
+            # Blank ratings default to 0, as in the new text window:
+            if len(entry) == 0:
+                entry = 0
+            try:
+                entry = int(entry)
+            except ValueError:
+                raise ValueError('Invalid parameter (rating must be an integer).')
+        elif field in ('Title','Attribution') and len(entry) == 0:
+            raise ValueError('Title and Attribution cannot be empty.')
+        values[field] = entry
+    return values
+
 def create_text():    
     # These variables will be used to save unproblematic user input for another try 
     # in case some input is invalid:
@@ -208,15 +867,16 @@ def create_text():
     default_comments = ''
     # Notes and comments only since they are optional
     # and potentially lengthy/annoying to lose
+    import mnemosyne_gui as gui
     
     # Receive and validate input:
     while (True):
         # Set new text fields to default values:
         new_edition_notes = default_edition_notes
         new_comments = default_comments
-        new_text_window = NewTextWindow('New Entry')
-        new_text_window.edition_notes.insert(tk.END,new_edition_notes)
-        new_text_window.comments.insert(tk.END,new_comments)
+        new_text_window = gui.NewTextWindow('New Entry')
+        new_text_window.edition_notes.insert(gui.tk.END,new_edition_notes)
+        new_text_window.comments.insert(gui.tk.END,new_comments)
 
         # Get user input:
         new_text_window.mainloop()
@@ -231,7 +891,7 @@ def create_text():
             # Set defaults fields for next loop:
             default_edition_notes = new_edition_notes
             default_comments = new_comments
-            error_window = ErrorWindow('Error: Title and Attribution are required.')
+            error_window = gui.ErrorWindow('Error: Title and Attribution are required.')
             error_window.mainloop()
             continue
         # If rating is empty or whitespace, set to 0:
@@ -244,7 +904,7 @@ def create_text():
             # Set defaults fields for next loop:
             default_edition_notes = new_edition_notes
             default_comments = new_comments
-            error_window = ErrorWindow('Error: Rating must be an integer.')
+            error_window = gui.ErrorWindow('Error: Rating must be an integer.')
             error_window.mainloop()
             continue
         break
@@ -260,7 +920,8 @@ def create_text():
 
 def change_text_field(text, field):
     if field in ('Edition Notes','Comments'):
-        input_window = InputWindow(text.info[field])
+        import mnemosyne_gui as gui
+        input_window = gui.InputWindow(text.info[field])
         input_window.mainloop()
         new_field_entry = input_window.new_field_entry
         text.edit(field, new_field_entry)
@@ -287,15 +948,16 @@ def change_all_text_fields(text):
     existing_comments = text.info['Comments']
     # Notes and comments only since they are optional
     # and potentially lengthy/annoying to lose
+    import mnemosyne_gui as gui
     
     while (True):
-        edit_text_window = NewTextWindow('Edit Entry')
+        edit_text_window = gui.NewTextWindow('Edit Entry')
         # Populate fields with current entries:
-        edit_text_window.text_title.insert(tk.END,text.info['Title'])
-        edit_text_window.attribution.insert(tk.END,text.info['Attribution'])
-        edit_text_window.rating.insert(tk.END,text.info['Rating'])
-        edit_text_window.edition_notes.insert(tk.END,existing_edition_notes)
-        edit_text_window.comments.insert(tk.END,existing_comments)
+        edit_text_window.text_title.insert(gui.tk.END,text.info['Title'])
+        edit_text_window.attribution.insert(gui.tk.END,text.info['Attribution'])
+        edit_text_window.rating.insert(gui.tk.END,text.info['Rating'])
+        edit_text_window.edition_notes.insert(gui.tk.END,existing_edition_notes)
+        edit_text_window.comments.insert(gui.tk.END,existing_comments)
         # Get new entries:
         edit_text_window.mainloop()
         new_title = edit_text_window.new_title
@@ -309,7 +971,7 @@ def change_all_text_fields(text):
             # Set defaults fields for next loop:
             existing_edition_notes = new_edition_notes
             existing_comments = new_comments
-            error_window = ErrorWindow('Error: Title and Attribution are required.')
+            error_window = gui.ErrorWindow('Error: Title and Attribution are required.')
             error_window.mainloop()
             continue
         # If rating is empty or whitespace, set to 0:
@@ -322,7 +984,7 @@ def change_all_text_fields(text):
             # Set defaults fields for next loop:
             existing_edition_notes = new_edition_notes
             existing_comments = new_comments
-            error_window = ErrorWindow('Error: Rating must be an integer.')
+            error_window = gui.ErrorWindow('Error: Rating must be an integer.')
             error_window.mainloop()
             continue
         break
@@ -335,18 +997,46 @@ def change_all_text_fields(text):
     text.edit('Comments', new_comments)
     return text
 
-def display_texts(list_of_texts):
-    for number, text in enumerate(list_of_texts):
-        print(f'[{number}]: {text}')
+# Prints the display's current page (or every page, for batch mode).
+# Only the entries shown are formatted, and they go out in a single write.
+def display_texts(display, all_pages=False):
+    with timings.timed('display'):
+        if all_pages:
+            start, stop = 0, len(display)
+        else:
+            start = display.page * DISPLAY_PAGE_SIZE
+            stop = min(start + DISPLAY_PAGE_SIZE, len(display))
+        lines = []
+        for number in range(start, stop):
+            try:
+                text = display[number]
+            except KeyError:
+                # Deleted since the search (the other entries keep their numbers):
+                continue
+            if text.library is None:
+                lines.append(f'[{number}]: {text}\n')
+            else:
+                lines.append(f'[{number}]: {text} ({text.library})\n')
+        if not all_pages and display.pages() > 1:
+            lines.append(f'Page {display.page + 1} of {display.pages()} ({len(display)} entries). Use next, prev or display [page] to see more.\n')
+        sys.stdout.write(''.join(lines))
+        sys.stdout.flush()
+    timings.count('lines printed', len(lines))
 
 def open_text(text):
     for field, entry in text.info.items():
+        # Fields starting with an underscore are record metadata, not for display:
+        if field.startswith('_'):
+            continue
         if field == 'Edition Notes' or field == 'Comments':
             print(f'{field.capitalize()}:\n{entry}')
         else:
             print(f'{field.capitalize()}: {entry}')
 
-def call_librarian(display, current_library, user_input):
+# batch=True is used by run_batch(): field values are read from the command itself instead of
+# opening windows, deletes aren't confirmed, and committing is left to the caller.
+def call_librarian(display, current_library, user_input, batch=False, autosave=None):
+    raw_input = user_input
     user_input = user_input.split()
     command = user_input[0]
     params = user_input[1:]
@@ -356,7 +1046,9 @@ def call_librarian(display, current_library, user_input):
 
     # Search commands:
     # search [field] [terms]
-    elif command == 'search' or command == 'search+':
+    # search [query] (see mnemosyne_query.py)
+    # search~ [field] [terms] (ranked)
+    elif command in ('search', 'search+', 'search~', 'search~+'):
         if not current_library:
             print('Error: No open library to search.')
             return (True, display, current_library)
@@ -364,21 +1056,103 @@ def call_librarian(display, current_library, user_input):
             print('Error: Missing parameter (field abbreviation).')
             print('Error: Missing parameter (search terms).')
             return (True, display, current_library)
+        # Anything but a lone field abbreviation first is a compound query:
+        if '~' not in command and params[0] not in FIELD_ABBREVIATIONS:
+            try:
+                with timings.timed('parse'):
+                    query = parse_query(raw_input.split(None,1)[1])
+            except ValueError as error:
+                print(f'Error: {error}')
+                return (True, display, current_library)
+            findings = browse_query(query, current_library)
+        else:
+            if len(params) == 1:
+                print('Error: Missing parameter (search terms).')
+                return (True, display, current_library)
+            try:
+                field = fieldparser(params[0])
+            except ValueError:
+                print('Error: Invalid parameter (field abbreviation).')
+                return (True, display, current_library)
+            search_terms = ' '.join(params[1:])
+            if '~' in command:
+                if field == 'Rating':
+                    print('Error: Invalid parameter (ranked searches are for text fields).')
+                    return (True, display, current_library)
+                findings = browse_ranked(field, search_terms, current_library)
+            else:
+                findings = browse(field, search_terms, current_library)
+        if command.endswith('+'):
+            # Show the page where the new results start:
+            first_new = len(display)
+            display = display + findings
+            display.page = min(first_new // DISPLAY_PAGE_SIZE, display.pages() - 1)
+        else:
+            display = findings
+        if len(display) > 0:
+            display_texts(display, batch)
+        else:
+            print('Not found.')
+
+    # Regular expression search:
+    # searchre [field] [pattern]
+    elif command == 'searchre' or command == 'searchre+':
+        if not current_library:
+            print('Error: No open library to search.')
+            return (True, display, current_library)
+        if len(params) == 0:
+            print('Error: Missing parameter (field abbreviation).')
+            print('Error: Missing parameter (pattern).')
+            return (True, display, current_library)
         if len(params) == 1:
-            print('Error: Missing parameter (search terms).')
+            print('Error: Missing parameter (pattern).')
             return (True, display, current_library)
         try:
             field = fieldparser(params[0])
         except ValueError:
             print('Error: Invalid parameter (field abbreviation).')
             return (True, display, current_library)
-        search_terms = ' '.join(params[1:])
+        # The pattern is the rest of the line as typed, spaces included:
+        pattern = raw_input.split(None,2)[2]
+        try:
+            findings = browse_scan(field, pattern, current_library, regex=True)
+        except re.error as error:
+            print(f'Error: Invalid parameter (pattern: {error}).')
+            return (True, display, current_library)
         if command.endswith('+'):
-            display = display + browse(field, search_terms, current_library)
+            # Show the page where the new results start:
+            first_new = len(display)
+            display = display + findings
+            display.page = min(first_new // DISPLAY_PAGE_SIZE, display.pages() - 1)
         else:
-            display = browse(field, search_terms, current_library)
+            display = findings
         if len(display) > 0:
-            display_texts(display)
+            display_texts(display, batch)
+        else:
+            print('Not found.')
+
+    # Search every library:
+    # searchall [field] [terms]
+    elif command == 'searchall':
+        if len(params) == 0:
+            print('Error: Missing parameter (field abbreviation).')
+            print('Error: Missing parameter (search terms).')
+            return (True, display, current_library)
+        if len(params) == 1:
+            print('Error: Missing parameter (search terms).')
+            return (True, display, current_library)
+        try:
+            field = fieldparser(params[0])
+        except ValueError:
+            print('Error: Invalid parameter (field abbreviation).')
+            return (True, display, current_library)
+        search_terms = ' '.join(params[1:])
+        if field == 'Rating' and not search_terms.lstrip('-').isdigit():
+            print('Error: Invalid parameter (rating).')
+            return (True, display, current_library)
+        display = search_all(field, search_terms, current_library)
+        if len(display) > 0:
+            display_texts(display, batch)
         else:
             print('Not found.')
 
@@ -401,8 +1175,31 @@ def call_librarian(display, current_library, user_input):
         except IndexError:
             print('Error: No such text.')
             return (True, display, current_library)
+        except KeyError:
+            print('Error: Text no longer in its library.')
+            return (True, display, current_library)
+        target_library = library_of(text_to_edit, current_library)
+        if text_to_edit.id not in target_library.records:
+            print('Error: Text no longer in its library.')
+            return (True, display, current_library)
+        # Edit the record as it is now (mmap and sqlite libraries hand each Text its own copy,
+        # which may be older than another Text's edit):
+        text_to_edit.info = target_library.records[text_to_edit.id]
         # Get field to edit if any and execute:
-        if len(params) < 2:
+        if batch:
+            # edit [display index] [field]:[value] | [field]:[value] ...
+            try:
+                values = parse_field_values(raw_input.split(None,2)[2] if len(params) > 1 else '')
+            except ValueError as error:
+                print(f'Error: {error}')
+                return (True, display, current_library)
+            if len(values) == 0:
+                print('Error: Missing parameter (field:value).')
+                return (True, display, current_library)
+            for field, entry in values.items():
+                text_to_edit.edit(field, entry)
+            changed_text = text_to_edit
+        elif len(params) < 2:
             changed_text = change_all_text_fields(text_to_edit)
         else:
             try:
@@ -413,8 +1210,13 @@ def call_librarian(display, current_library, user_input):
                 return (True, display, current_library)
             changed_text = change_text_field(text_to_edit,field)
         # Save edit:
-        write_to_library(changed_text,current_library)
+        write_to_library(changed_text,target_library)
         display[display_index] = changed_text
+        # Edits to other libraries are saved right away:
+        if target_library is not current_library:
+            target_library.commit()
+            target_library.sync()
+            renumber_display(display, target_library, current_library)
 
 
     # Open commands:
@@ -433,10 +1235,30 @@ def call_librarian(display, current_library, user_input):
         except IndexError:
             print('Error: No such text.')
             return (True, display, current_library)
-        open_text(display[display_index])
+        except KeyError:
+            print('Error: Text no longer in its library.')
+            return (True, display, current_library)
+        open_text(text_to_open)
 
     elif command == 'new':
-        new_text = create_text()
+        if not current_library:
+            print('Error: No open library.')
+            return (True, display, current_library)
+        if batch:
+            # new [field]:[value] | [field]:[value] ...
+            try:
+                values = parse_field_values(raw_input.split(None,1)[1] if len(params) > 0 else '')
+            except ValueError as error:
+                print(f'Error: {error}')
+                return (True, display, current_library)
+            if 'Title' not in values or 'Attribution' not in values:
+                print('Error: Title and Attribution are required.')
+                return (True, display, current_library)
+            new_text = Text()
+            for field in ('Title','Attribution','Rating','Edition Notes','Comments'):
+                new_text.edit(field, values.get(field, 0 if field == 'Rating' else ''))
+        else:
+            new_text = create_text()
         display.append(new_text)
         write_to_library(new_text, current_library)
 
@@ -457,23 +1279,68 @@ def call_librarian(display, current_library, user_input):
         except IndexError:
             print('Error: No such text.')
             return (True, display, current_library)
-        print(f'Are you sure you want to delete entry {display_index} ({display[display_index]})?')
-        confirmation = input('y/n: ')
-        if confirmation == 'n':
-            print('Nothing deleted.')
+        except KeyError:
+            print('Error: Text no longer in its library.')
+            return (True, display, current_library)
+        target_library = library_of(text_to_delete, current_library)
+        if text_to_delete.id not in target_library.records:
+            print('Error: Text no longer in its library.')
             return (True, display, current_library)
-        current_library.delete_entry(text_to_delete.index)
-        display.pop(display_index)
+        if not batch:
+            print(f'Are you sure you want to delete entry {display_index} ({display[display_index]})?')
+            confirmation = input('y/n: ')
+            if confirmation == 'n':
+                print('Nothing deleted.')
+                return (True, display, current_library)
+        target_library.delete_entry(text_to_delete.id)
+        if target_library is not current_library:
+            target_library.commit()
+            target_library.sync()
+            renumber_display(display, target_library, current_library)
+        # Drop the record from the display wherever it appears (other entries keep their ids):
+        current_name = current_library.name if current_library else None
+        display.discard(text_to_delete.id, text_to_delete.library or current_name, current_name)
         print('Entry deleted.')
 
+    # newlib (asks for the name)
+    # newlib [library name] (batch mode)
     elif command == 'newlib':
-        new_library_name = input('Enter new library name (must be a valid filename, no spaces): ')
+        if batch:
+            if len(params) == 0:
+                print('Error: Missing parameter (library name).')
+                return (True, display, current_library)
+            new_library_name = params[0]
+        else:
+            new_library_name = input('Enter new library name (must be a valid filename, no spaces): ')
         if len(new_library_name.strip()) == 0 or ' ' in new_library_name:
             print('Error: Invalid library name.')
             return (True, display, current_library)
         new_library = create_library(new_library_name)
+        # Save changes still waiting (for autosave, or for the end of a batch):
+        if current_library:
+            current_library.commit()
+            current_library.sync()
         print(f'{new_library_name} is now open.')
         current_library = new_library
+        # Texts in the display belong to the old library (and ids are only unique within a library):
+        display = Display()
+
+    # Export library as pretty JSON:
+    # export [filename]
+    elif command == 'export':
+        if not current_library:
+            print('Error: No open library to export.')
+            return (True, display, current_library)
+        try:
+            export_filename = params[0]
+        except IndexError:
+            # Binary and SQLite libraries get a separate JSON copy:
+            if current_library.file_format in ('binary', 'sqlite'):
+                export_filename = current_library.name+'_export.json'
+            else:
+                export_filename = current_library.filename
+        export_library(current_library, export_filename)
+        print(f'{current_library.name} exported to {export_filename}.')
 
     elif command == 'switchdefault':
         set_default_library(current_library.name)
@@ -488,52 +1355,252 @@ def call_librarian(display, current_library, user_input):
             print('Error: Missing parameter (library name).')
             return (True, display, current_library)
         if check_valid_library(library_to_open):
+            # Save changes still waiting (for autosave, or for the end of a batch) before the library is read again:
+            if current_library:
+                current_library.commit()
+                current_library.sync()
             current_library = open_library(library_to_open)
             print(f'{library_to_open} is now open.')
+            # Texts in the display belong to the old library (and ids are only unique within a library):
+            display = Display()
         else:
             print('Error: Invalid library name.')
 
-    elif command == 'display':
+    # Move the current library to another storage engine:
+    # migrate [storage] (json, journal, mmap or sqlite)
+    elif command == 'migrate':
+        if not current_library:
+            print('Error: No open library.')
+            return (True, display, current_library)
+        if len(params) == 0 or params[0] not in ('json', 'journal', 'mmap', 'sqlite'):
+            print('Error: Missing or invalid parameter (storage: json, journal, mmap or sqlite).')
+            return (True, display, current_library)
+        old_filename = current_library.filename
+        try:
+            with timings.timed('migrate'):
+                migrated_library = migrate_library(current_library, params[0])
+        except ValueError as error:
+            print(f'Error: {error}.')
+            return (True, display, current_library)
+        print(f'{current_library.name} now uses {params[0]} storage ({migrated_library.filename}).')
+        if old_filename != migrated_library.filename and os.path.exists(old_filename):
+            print(f'The old file {old_filename} has been kept as a backup.')
+        current_library = migrated_library
+        display = Display()
+
+    # Sort commands:
+    # sort [field] (A to Z, lowest rating first)
+    # sort [field] desc
+    elif command == 'sort':
+        if not current_library:
+            print('Error: No open library.')
+            return (True, display, current_library)
+        if len(params) == 0:
+            print('Error: Missing parameter (field abbreviation).')
+            return (True, display, current_library)
+        try:
+            field = fieldparser(params[0])
+        except ValueError:
+            print('Error: Invalid parameter (field abbreviation).')
+            return (True, display, current_library)
+        if len(params) > 1 and params[1] != 'desc':
+            print('Error: Invalid parameter (order must be desc or left out).')
+            return (True, display, current_library)
+        display = sorted_texts(field, current_library, len(params) > 1)
         if len(display) > 0:
-            display_texts(display)
+            display_texts(display, batch)
         else:
             print('Nothing to display.')
 
+    # dedupe (puts groups of possible duplicates in the display for review)
+    elif command == 'dedupe':
+        if not current_library:
+            print('Error: No open library.')
+            return (True, display, current_library)
+        groups = find_duplicates(current_library)
+        if len(groups) == 0:
+            print('No duplicates found.')
+            return (True, display, current_library)
+        display = found_texts([record_id for group in groups for record_id in group], current_library)
+        print(f'Found {len(groups)} groups of possible duplicates ({len(display)} records), listed one group after another.')
+        display_texts(display, batch)
+
+    # Display commands:
+    # display (the current page)
+    # display [page]
+    # next
+    # prev
+    elif command in ('display', 'next', 'prev'):
+        if len(display) == 0:
+            print('Nothing to display.')
+            return (True, display, current_library)
+        if command == 'next':
+            if display.page + 1 >= display.pages():
+                print('Error: Already on the last page.')
+                return (True, display, current_library)
+            display.page += 1
+        elif command == 'prev':
+            if display.page == 0:
+                print('Error: Already on the first page.')
+                return (True, display, current_library)
+            display.page -= 1
+        elif len(params) > 0:
+            try:
+                page = int(params[0])
+            except ValueError:
+                print('Error: Invalid parameter (page number).')
+                return (True, display, current_library)
+            if page < 1 or page > display.pages():
+                print(f'Error: No such page (there are {display.pages()}).')
+                return (True, display, current_library)
+            display.page = page - 1
+        # A plain display in batch mode shows everything:
+        display_texts(display, batch and command == 'display' and len(params) == 0)
+
+    # stats
+    # stats reset (forgets the timings so far)
+    elif command == 'stats':
+        if len(params) > 0 and params[0] == 'reset':
+            timings.clear()
+            print('Timings reset.')
+            return (True, display, current_library)
+        if current_library:
+            # Counts are kept up to date by the index (or come from the database's), so this doesn't go through the records:
+            total = len(current_library.positions)
+            if current_library.storage == 'sqlite':
+                rating_counts = current_library.store.rating_counts()
+                author_count = current_library.store.attribution_count()
+                top_authors = current_library.store.top_attributions(STATS_AUTHORS)
+            else:
+                ratings = current_library.index.ratings
+                rating_counts = {rating: len(ratings.postings[rating]) for rating in ratings.sorted_ratings}
+                authors = current_library.index.sorted_by('Attribution').counts
+                author_count = len(authors)
+                top_authors = authors.most_common(STATS_AUTHORS)
+            print(f'{current_library.name}: {total} records by {author_count} authors.')
+            if total > 0:
+                average = sum(rating * count for rating, count in rating_counts.items()) / total
+                print('Ratings: ' + ', '.join(f'{rating}: {count}' for rating, count in rating_counts.items()) + f' (average {average:.2f}).')
+                print('Most records: ' + ', '.join(f'{author} ({count})' for author, count in top_authors) + '.')
+            cache = current_library.cache
+            print(f'Query cache: {len(cache.entries)} searches cached, {cache.hits} hits, {cache.misses} misses ({cache.hit_rate():.0%} hit rate), {cache.invalidations} invalidated, {cache.evictions} evicted.')
+        report = timings.report()
+        if report:
+            print('Timings:')
+            print('\n'.join(report))
+        else:
+            print('No timings yet.')
+
     elif command == 'help':
         print('See readme.txt')
 
     else:
         print('Error: Invalid command.')
 
-    # Autocommit changes if any:
-    if current_library and command in ('edit', 'new', 'del'):
-        current_library.commit()
+    # Autocommit changes if any (in the background with autosave):
+    if current_library and command in ('edit', 'new', 'del') and not batch:
+        if autosave:
+            autosave.request(current_library)
+        else:
+            current_library.commit()
+            renumber_display(display, current_library, current_library)
 
     return (True, display, current_library)
 
+# Runs librarian commands from lines (a file or stdin) without prompting.
+# All changes are committed once at the end, or whenever commit_every changes have piled up.
+# A command that fails is reported with its line number and the batch carries on.
+def run_batch(lines, current_library, commit_every=0):
+    display = Display()
+    commands = 0
+    failed = 0
+    changes = 0
+    commits = 0
+    start = time.perf_counter()
+    for line_number, line in enumerate(lines, 1):
+        # Skip blank lines and comments:
+        if len(line.strip()) == 0 or line.lstrip().startswith('#'):
+            continue
+        previous_library = current_library
+        # Changes waiting to be committed (switching library commits them):
+        pending = len(current_library.changes) if current_library else 0
+        commands += 1
+        try:
+            with timings.timed_command(line):
+                status, display, current_library = call_librarian(display, current_library, line.rstrip('\n'), batch=True)
+        except Exception as error:
+            print(f'Error: Line {line_number} ({line.strip()}) failed: {error!r}')
+            failed += 1
+            continue
+        # The old library was committed before moving on to another one:
+        if previous_library and current_library is not previous_library and pending:
+            changes += pending
+            commits += 1
+        if not status:
+            break
+        if current_library and commit_every and len(current_library.changes) >= commit_every:
+            changes += len(current_library.changes)
+            current_library.commit()
+            commits += 1
+            renumber_display(display, current_library, current_library)
+    if current_library and current_library.changes:
+        changes += len(current_library.changes)
+        current_library.commit()
+        commits += 1
+    if current_library:
+        current_library.sync()
+    elapsed = time.perf_counter() - start
+    rate = commands / elapsed if elapsed > 0 else 0
+    print(f'Batch done: {commands} commands ({failed} failed, {changes} changes, {commits} commits) in {elapsed:.2f} s ({rate:.0f} commands/s).')
+    return current_library
+
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Command line app for maintaining a personal record of books.')
+    parser.add_argument('--batch', metavar='FILE', help='run the commands in FILE (- for stdin) and exit')
+    parser.add_argument('--commit-every', metavar='N', type=int, default=0, help='in batch mode, commit after every N changes instead of once at the end')
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const='mnemosyne.prof', help='profile the session with cProfile and write the stats to FILE (default mnemosyne.prof) on exit')
+    parser.add_argument('--timing-log', metavar='FILE', help='append the time of every command and step to FILE as JSON lines')
+    args = parser.parse_args()
+
+    if args.timing_log:
+        timings.open_log(args.timing_log)
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    # Writes out the profile and the timing log (called on every way out).
+    # Saves made by the autosave thread are profiled separately and added in:
+    def finish(autosave=None):
+        if args.profile:
+            import pstats
+            profiler.disable()
+            stats = pstats.Stats(profiler)
+            if autosave is not None and autosave.profiler is not None:
+                stats.add(autosave.profiler)
+            stats.dump_stats(args.profile)
+            print(f'Profile written to {args.profile} (view it with: python3 -m pstats {args.profile}).')
+        timings.close_log()
+
     # Initialze: load default library
     # Open config.json and search for default library name:
     default_library_name = None
     current_library = None
-    try:
-        with open('config.json','r') as config_file:
-            config = json.load(config_file)
-            # If config is empty, prompt user to create default library:
-            if len(config) == 0:
-                print('No libraries defined in config.json. Please create one.')
-                call_librarian([], None, 'newlib')
-            # Else open default library:
-            else:
-                for entry in config:
-                    if entry['is_default']:
-                        default_library_name = entry['name']
-    except FileNotFoundError:
+    if not config_registry.exists():
         print('Cannot find config.json.')
         print('Creating config.json...')
-        with open('config.json','w') as config_file:
-            json.dump([],config_file,indent=4)
+        config_registry.save()
+    # If config is empty, prompt user to create default library:
+    # (In batch mode the batch itself can create one with newlib [name].)
+    elif len(config_registry.names()) == 0:
+        print('No libraries defined in config.json. Please create one.')
+        if not args.batch:
+            current_library = call_librarian(Display(), None, 'newlib')[2]
+    # Else open default library:
+    else:
+        default_library_name = config_registry.default_name()
     # Try to open default library:
     if default_library_name:
         try:
@@ -543,19 +1610,49 @@ if __name__ == '__main__':
     if not current_library:
         print('No default library defined. Create a new library with command: newlib, or open an existing one. Set as default with command: switchdefault')
 
+    # Batch mode:
+    if args.batch:
+        if args.batch == '-':
+            run_batch(sys.stdin, current_library, args.commit_every)
+        else:
+            with open(args.batch,'r',encoding='utf8') as batch_file:
+                run_batch(batch_file, current_library, args.commit_every)
+        finish()
+        sys.exit()
+
     status = True
-    display = []
+    display = Display()
  
-    # Main loop:
-    while status == True:
-        user_input = input('Instructions: ')
-        # Don't accept input if blank:
-        if len(user_input) == 0 or user_input.isspace():
-            continue
-        call = call_librarian(display, current_library, user_input)
-        status = call[0]
-        display = call[1]
-        current_library = call[2]
-        #print('\n')
-    if current_library:
-        current_library.commit()
\ No newline at end of file
+    # Changes are saved by a background thread (see mnemosyne_autosave.py):
+    autosave = Autosaver(profile=bool(args.profile))
+
+    # Main loop (Ctrl-D or Ctrl-C also quit, and pending changes are still saved):
+    try:
+        while status == True:
+            with autosave.lock:
+                for error in autosave.take_errors():
+                    print(f'Error: Autosave failed ({error}). Your changes will be saved again with the next change or on exit.')
+                if current_library:
+                    renumber_display(display, current_library, current_library)
+            user_input = input('Instructions: ')
+            # Don't accept input if blank:
+            if len(user_input) == 0 or user_input.isspace():
+                continue
+            with autosave.lock, timings.timed_command(user_input):
+                call = call_librarian(display, current_library, user_input, autosave=autosave)
+            status = call[0]
+            display = call[1]
+            current_library = call[2]
+            #print('\n')
+    except (EOFError, KeyboardInterrupt):
+        print()
+    finally:
+        # Wait for a save in progress, then save what's left in the foreground:
+        try:
+            autosave.close()
+        except Exception as error:
+            print(f'Error: Autosave failed ({error}).')
+        if current_library:
+            current_library.commit()
+            current_library.sync()
+        finish(autosave)
\ No newline at end of file
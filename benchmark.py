@@ -0,0 +1,543 @@
+# Benchmarks for Mnemosyne.
+# Run from the Mnemosyne folder:
+# python3 benchmark.py import
+# python3 benchmark.py suite [--sizes 1000 100000 1000000] [--output results.json]
+# python3 benchmark.py compare old_results.json new_results.json
+# python3 benchmark.py stress [--writers 8] [--commits 50] [--storage journal]
+# python3 benchmark.py engines [--sizes 10000 100000] [--output results.json]
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from mnemosyne_storage import write_snapshot
+from mnemosyne_sqlite import SqliteStore
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is reported as None there.
+    resource = None
+
+SUITE_SIZES = (1000, 100000, 1000000)
+ENGINE_SIZES = (10000, 100000)
+ENGINES = ('json', 'sqlite')
+GOODREADS_HEADER = ['Book Id','Title','Author','Author l-f','Additional Authors','ISBN','ISBN13','My Rating',
+    'Average Rating','Publisher','Binding','Number of Pages','Year Published','Original Publication Year',
+    'Date Read','Date Added','Bookshelves','Bookshelves with positions','Exclusive Shelf','My Review',
+    'Spoiler','Private Notes','Read Count','Owned Copies']
+
+
+# Import time of the core module in a fresh interpreter, compared with also loading the GUI
+# (which is what every import of Mnemosyne.py cost before the Tk windows moved to mnemosyne_gui.py).
+def benchmark_import(runs):
+    statements = {
+        'core (import Mnemosyne)': 'import Mnemosyne',
+        'core + GUI (import Mnemosyne, mnemosyne_gui)': 'import Mnemosyne, mnemosyne_gui',
+        'interpreter only': 'pass',
+        }
+    results = {}
+    for label, statement in statements.items():
+        timings = []
+        for run in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', statement], check=True)
+            timings.append(time.perf_counter() - start)
+        results[label] = statistics.median(timings)
+    baseline = results.pop('interpreter only')
+    print(f'Median over {runs} runs (interpreter startup of {baseline*1000:.1f} ms subtracted):')
+    for label, timing in results.items():
+        print(f'{label}: {(timing-baseline)*1000:.1f} ms')
+    core, with_gui = (timing - baseline for timing in results.values())
+    if core > 0:
+        print(f'Speedup: {with_gui/core:.1f}x')
+    return results
+
+
+# Synthetic data:
+# Words are made up from syllables and drawn with Zipf-like frequencies, so token and substring
+# statistics look like real text rather than uniform noise.
+
+SYLLABLES = ['ka','lo','mi','ra','ten','dor','el','an','is','ur','bel','gan','tho','ri','wen','sa','mor','lin','ve','qu']
+
+def make_vocabulary(size, rng):
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add(''.join(rng.choice(SYLLABLES) for syllable in range(rng.randint(1,4))))
+    vocabulary = sorted(vocabulary)
+    rng.shuffle(vocabulary)
+    # Cumulative 1/rank weights for random.choices:
+    cumulative_weights = []
+    total = 0
+    for rank in range(1, size+1):
+        total += 1 / rank
+        cumulative_weights.append(total)
+    return vocabulary, cumulative_weights
+
+def make_words(vocabulary, count, rng):
+    words, cumulative_weights = vocabulary
+    return ' '.join(rng.choices(words, cum_weights=cumulative_weights, k=count))
+
+# Word count with a long tail (most texts are short, a few are very long):
+def text_length(rng, median, limit):
+    return min(limit, max(1, int(rng.lognormvariate(0, 0.9) * median)))
+
+def generate_library(size, seed=0):
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(20000, rng)
+    # Authors repeat, with a few prolific ones:
+    authors = [f'{make_words(vocabulary, 1, rng).title()} {make_words(vocabulary, 1, rng).title()}' for author in range(max(50, size//20))]
+    author_weights = [1 / rank for rank in range(1, len(authors)+1)]
+    records = []
+    for record_id in range(size):
+        records.append({
+            'Title': make_words(vocabulary, text_length(rng, 3, 20), rng).capitalize(),
+            'Attribution': rng.choices(authors, weights=author_weights)[0],
+            'Rating': rng.choices(range(6), weights=[30,2,5,15,25,23])[0],
+            'Edition Notes': make_words(vocabulary, text_length(rng, 6, 40), rng) if rng.random() < 0.5 else '',
+            'Comments': make_words(vocabulary, text_length(rng, 60, 2000), rng) if rng.random() < 0.4 else '',
+            '_id': record_id
+            })
+    return records
+
+def write_goodreads_csv(filename, records, seed=0):
+    rng = random.Random(seed)
+    with open(filename,'w',newline='',encoding='utf8') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(GOODREADS_HEADER)
+        for record in records:
+            row = [''] * len(GOODREADS_HEADER)
+            row[0] = str(record['_id'] + 1000000)
+            row[1] = record['Title']
+            row[2] = record['Attribution']
+            row[7] = str(record['Rating'])
+            row[9] = record['Edition Notes']
+            row[19] = record['Comments']
+            row[22] = str(rng.choice((0, 0, 1, 1, 1, 2)))
+            writer.writerow(row)
+
+
+# Measurements:
+
+def summarize(timings):
+    timings = sorted(timings)
+    def percentile(fraction):
+        return timings[min(len(timings)-1, int(fraction * len(timings)))] * 1000
+    return {
+        'count': len(timings),
+        'mean_ms': statistics.fmean(timings) * 1000,
+        'p50_ms': percentile(0.5),
+        'p90_ms': percentile(0.9),
+        'p99_ms': percentile(0.99),
+        'max_ms': timings[-1] * 1000,
+        }
+
+# Peak resident memory of this process in KB:
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports KB:
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+# Each operation runs in its own fresh process (see run_suite) so that peak RSS belongs to it alone.
+
+def measure_open(directory, repeats, seed):
+    os.chdir(directory)
+    import Mnemosyne
+    timings = [timed(Mnemosyne.open_library, 'bench')[0] for repeat in range(repeats)]
+    return {'latency': summarize(timings), 'peak_rss_kb': peak_rss()}
+
+def measure_browse(directory, repeats, seed):
+    os.chdir(directory)
+    import Mnemosyne
+    rng = random.Random(seed)
+    library = Mnemosyne.open_library('bench')
+    records = [record for record in library.contents if record is not None]
+    # Whole words, word fragments and multi-word phrases taken from real records:
+    queries = []
+    for repeat in range(repeats):
+        field = rng.choice(('Title','Attribution','Comments','Edition Notes'))
+        words = rng.choice(records)[field].split() or ['a']
+        word = rng.choice(words)
+        queries.append((field, rng.choice((word, word[1:4], ' '.join(words[:2])))))
+        queries.append(('Rating', str(rng.randint(0,5))))
+    timings = {}
+    hits = 0
+    for field, query in queries:
+        timing, findings = timed(Mnemosyne.browse, field, query, library)
+        timings.setdefault(field, []).append(timing)
+        hits += len(findings)
+    result = {field: summarize(field_timings) for field, field_timings in timings.items()}
+    result['all'] = summarize([timing for field_timings in timings.values() for timing in field_timings])
+    return {'latency': result, 'hits': hits, 'peak_rss_kb': peak_rss()}
+
+def measure_write(directory, repeats, seed):
+    os.chdir(directory)
+    import Mnemosyne
+    rng = random.Random(seed)
+    library = Mnemosyne.open_library('bench')
+    update_timings = []
+    for record_id in rng.sample(sorted(library.records), min(repeats * 10, len(library.records))):
+        text = Mnemosyne.Text()
+        text.id = record_id
+        text.info = library.records[record_id]
+        text.edit('Rating', rng.randint(0,5))
+        text.edit('Comments', text.info['Comments'] + ' edited')
+        update_timings.append(timed(Mnemosyne.write_to_library, text, library)[0])
+    insert_timings = []
+    for repeat in range(repeats * 10):
+        text = Mnemosyne.Text()
+        for field, entry in (('Title','New book'),('Attribution','New author'),('Rating',3),('Edition Notes',''),('Comments','')):
+            text.edit(field, entry)
+        insert_timings.append(timed(Mnemosyne.write_to_library, text, library)[0])
+    return {'latency': {'update': summarize(update_timings), 'insert': summarize(insert_timings)}, 'peak_rss_kb': peak_rss()}
+
+def measure_commit(directory, repeats, seed):
+    os.chdir(directory)
+    import Mnemosyne
+    rng = random.Random(seed)
+    library = Mnemosyne.open_library('bench')
+    record_ids = list(library.records)
+    timings = {}
+    # One edit per commit, as the librarian does:
+    for storage in ('json', 'journal'):
+        library.storage = storage
+        storage_timings = []
+        for repeat in range(repeats):
+            text = Mnemosyne.Text()
+            text.id = rng.choice(record_ids)
+            text.info = library.records[text.id]
+            text.edit('Rating', rng.randint(0,5))
+            Mnemosyne.write_to_library(text, library)
+            storage_timings.append(timed(library.commit)[0])
+        timings[storage] = summarize(storage_timings)
+    return {'latency': timings, 'peak_rss_kb': peak_rss()}
+
+def measure_import(directory, repeats, seed):
+    os.chdir(directory)
+    import goodreads_library_scanner
+    timing, (imported, duplicates) = timed(goodreads_library_scanner.import_goodreads, 'goodreads_bench.csv', 'imported', 1, 1)
+    return {'latency': summarize([timing]), 'records': imported, 'peak_rss_kb': peak_rss()}
+
+OPERATIONS = {
+    'open_library': measure_open,
+    'browse': measure_browse,
+    'write_to_library': measure_write,
+    'commit': measure_commit,
+    'goodreads_import': measure_import,
+    }
+
+def run_suite(sizes, repeats, seed):
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'repeats': repeats,
+        'seed': seed,
+        'sizes': {},
+        }
+    # Fresh interpreters (not forks) so each measurement starts from an empty process:
+    context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        print(f'{size} records: generating...')
+        with tempfile.TemporaryDirectory() as directory:
+            records = generate_library(size, seed)
+            write_snapshot(os.path.join(directory, 'bench.json'), records, 'pretty')
+            write_goodreads_csv(os.path.join(directory, 'goodreads_bench.csv'), records, seed)
+            del records
+            with open(os.path.join(directory, 'config.json'),'w') as config_file:
+                json.dump([{'name':'bench','is_default':True}],config_file,indent=4)
+            size_results = {'library_bytes': os.path.getsize(os.path.join(directory, 'bench.json'))}
+            for name, operation in OPERATIONS.items():
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    size_results[name] = executor.submit(operation, directory, repeats, seed).result()
+                print(f'{size} records: {name}: p50 {median_of(size_results[name]):.2f} ms, peak RSS {size_results[name]["peak_rss_kb"]} KB')
+            results['sizes'][str(size)] = size_results
+    return results
+
+# Comparison of the storage engines: the same library kept as JSON and in SQLite, and the same
+# operations on each, every one in a fresh process.
+
+# Compound queries and sorted listings:
+def measure_query(directory, repeats, seed):
+    os.chdir(directory)
+    import Mnemosyne
+    from mnemosyne_query import parse_query
+    rng = random.Random(seed)
+    library = Mnemosyne.open_library('bench')
+    records = [record for record in library.contents if record is not None]
+    query_timings = []
+    hits = 0
+    for repeat in range(repeats):
+        record = rng.choice(records)
+        title_word = rng.choice(record['Title'].split())
+        comments_word = rng.choice(record['Comments'].split() or ['a'])
+        query = f't:{title_word[:4]} r>={rng.randint(0,5)} OR (c:{comments_word} -a:{record["Attribution"][:3]})'
+        timing, findings = timed(Mnemosyne.browse_query, parse_query(query), library)
+        query_timings.append(timing)
+        hits += len(findings)
+    sort_timings = {}
+    for field in ('Title', 'Rating'):
+        sort_timings[field] = summarize([timed(Mnemosyne.sorted_texts, field, library)[0] for repeat in range(repeats)])
+    return {'latency': {'compound': summarize(query_timings), 'sort': sort_timings}, 'hits': hits, 'peak_rss_kb': peak_rss()}
+
+# One edit, or one new record, per commit, in the library's own storage:
+def measure_engine_commit(directory, repeats, seed):
+    os.chdir(directory)
+    import Mnemosyne
+    rng = random.Random(seed)
+    library = Mnemosyne.open_library('bench')
+    record_ids = list(library.records)
+    update_timings = []
+    insert_timings = []
+    for repeat in range(repeats):
+        text = Mnemosyne.Text()
+        text.id = rng.choice(record_ids)
+        text.info = library.records[text.id]
+        text.edit('Rating', rng.randint(0,5))
+        start = time.perf_counter()
+        Mnemosyne.write_to_library(text, library)
+        library.commit()
+        update_timings.append(time.perf_counter() - start)
+        text = Mnemosyne.Text()
+        for field, entry in (('Title','New book'),('Attribution','New author'),('Rating',3),('Edition Notes',''),('Comments','')):
+            text.edit(field, entry)
+        start = time.perf_counter()
+        Mnemosyne.write_to_library(text, library)
+        library.commit()
+        insert_timings.append(time.perf_counter() - start)
+    return {'latency': {'update': summarize(update_timings), 'insert': summarize(insert_timings)}, 'peak_rss_kb': peak_rss()}
+
+ENGINE_OPERATIONS = {
+    'open_library': measure_open,
+    'browse': measure_browse,
+    'query': measure_query,
+    'commit': measure_engine_commit,
+    }
+
+# Writes records as library 'bench' in directory, in the given storage:
+def write_engine_library(directory, records, storage):
+    if storage == 'sqlite':
+        store = SqliteStore(os.path.join(directory, 'bench.sqlite'))
+        store.bulk_load(records)
+        store.close()
+    else:
+        write_snapshot(os.path.join(directory, 'bench.json'), records, 'pretty')
+    with open(os.path.join(directory, 'config.json'),'w') as config_file:
+        json.dump([{'name':'bench','is_default':True,'storage':storage}],config_file,indent=4)
+
+def run_engines(sizes, repeats, seed):
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'repeats': repeats,
+        'seed': seed,
+        'sizes': {},
+        }
+    context = multiprocessing.get_context('spawn')
+    for size in sizes:
+        print(f'{size} records: generating...')
+        records = generate_library(size, seed)
+        size_results = {}
+        for storage in ENGINES:
+            with tempfile.TemporaryDirectory() as directory:
+                write_engine_library(directory, records, storage)
+                storage_results = {'library_bytes': os.path.getsize(os.path.join(directory, 'bench' + ('.sqlite' if storage == 'sqlite' else '.json')))}
+                for name, operation in ENGINE_OPERATIONS.items():
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        storage_results[name] = executor.submit(operation, directory, repeats, seed).result()
+                size_results[storage] = storage_results
+        del records
+        # Each p50 and peak RSS side by side:
+        print(f'{size} records:{"":<38}' + ''.join(f'{storage:>12}' for storage in ENGINES))
+        for name in ['library_bytes'] + list(ENGINE_OPERATIONS):
+            if name == 'library_bytes':
+                rows = {'file size (KB)': [size_results[storage][name] // 1024 for storage in ENGINES]}
+            else:
+                rows = {}
+                for storage in ENGINES:
+                    for metric, value in flatten_metrics(size_results[storage][name], f'{name}/'):
+                        rows.setdefault(metric, []).append(value)
+            for metric, values in rows.items():
+                print(f'  {metric:<46}' + ''.join(f'{value:>12.2f}' if isinstance(value, float) else f'{value:>12}' for value in values))
+        results['sizes'][str(size)] = size_results
+    return results
+
+# (name, value) of every p50 and peak RSS in a result:
+def flatten_metrics(result, prefix=''):
+    for key, value in result.items():
+        if isinstance(value, dict):
+            yield from flatten_metrics(value, f'{prefix}{key}/')
+        elif key in ('p50_ms', 'peak_rss_kb') and value is not None:
+            yield f'{prefix}{key}', value
+
+# The headline p50 of an operation (the first one if it has several):
+def median_of(result):
+    latency = result['latency']
+    while 'p50_ms' not in latency:
+        latency = next(iter(latency.values()))
+    return latency['p50_ms']
+
+# Prints every p50 and peak RSS of two saved runs side by side:
+def compare(old_filename, new_filename):
+    with open(old_filename,'r') as old_file:
+        old = json.load(old_file)
+    with open(new_filename,'r') as new_file:
+        new = json.load(new_file)
+    for size, new_size_results in new['sizes'].items():
+        old_metrics = dict(flatten_metrics(old['sizes'].get(size, {})))
+        for metric, value in flatten_metrics(new_size_results):
+            if metric in old_metrics and old_metrics[metric]:
+                print(f'{size:>8} {metric:<45} {old_metrics[metric]:>12.2f} {value:>12.2f} {value/old_metrics[metric]:>7.2f}x')
+
+# Stress test for concurrent access: several writer processes add, edit and delete records in one
+# library at the same time, committing after every change, while reader processes keep opening it.
+# Every writer's changes must survive the merges, and readers must only ever see complete libraries.
+
+def stress_writer(directory, writer, commits, seed):
+    os.chdir(directory)
+    import Mnemosyne
+    rng = random.Random(seed + writer)
+    library = Mnemosyne.open_library('stress', index=False)
+    # Ids of this writer's records, and what their comments should end up as:
+    expected = {}
+    merges = 0
+    start = time.perf_counter()
+    for commit in range(commits):
+        action = rng.random()
+        if expected and action < 0.2:
+            record_id = rng.choice(list(expected))
+            library.delete_entry(record_id)
+            del expected[record_id]
+        elif expected and action < 0.5:
+            record_id = rng.choice(list(expected))
+            record = library.records[record_id]
+            record['Comments'] = f'edited by {writer} in commit {commit}'
+            library.update_entry(record_id, record)
+            expected[record_id] = record['Comments']
+        else:
+            record = {'Title':f'writer {writer} record {commit}','Attribution':f'Writer {writer}','Rating':0,'Edition Notes':'','Comments':''}
+            expected[library.insert_entry(record)] = ''
+        generation = library.generation
+        library.commit()
+        # Another writer committed in between if the generation moved by more than this commit's own 2:
+        if library.generation - generation > 2:
+            merges += 1
+        expected = {library.renumbered.get(record_id, record_id): comments for record_id, comments in expected.items()}
+        library.renumbered = {}
+    elapsed = time.perf_counter() - start
+    return {'expected': expected, 'merges': merges, 'seconds': elapsed}
+
+def stress_reader(directory, duration):
+    os.chdir(directory)
+    import Mnemosyne
+    opens = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        library = Mnemosyne.open_library('stress', index=False)
+        ids = [record['_id'] for record in library.contents if record is not None]
+        if len(ids) != len(set(ids)):
+            raise AssertionError('reader saw duplicate ids')
+        opens += 1
+    return opens
+
+def run_stress(writers, commits, storage, readers, seed):
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        if storage == 'sqlite':
+            SqliteStore(os.path.join(directory, 'stress.sqlite')).close()
+        else:
+            file_format = 'binary' if storage == 'mmap' else 'compact'
+            write_snapshot(os.path.join(directory, 'stress' + ('.mnemo' if file_format == 'binary' else '.json')), [], file_format)
+        with open(os.path.join(directory, 'config.json'),'w') as config_file:
+            json.dump([{'name':'stress','is_default':True,'storage':storage}],config_file,indent=4)
+        with ProcessPoolExecutor(max_workers=writers+readers, mp_context=context) as executor:
+            start = time.perf_counter()
+            writer_futures = [executor.submit(stress_writer, directory, writer, commits, seed) for writer in range(writers)]
+            # Readers run for about as long as the writers (estimated from a short head start):
+            reader_futures = [executor.submit(stress_reader, directory, max(1.0, commits * writers * 0.002)) for reader in range(readers)]
+            results = [future.result() for future in writer_futures]
+            elapsed = time.perf_counter() - start
+            opens = sum(future.result() for future in reader_futures)
+        working_directory = os.getcwd()
+        os.chdir(directory)
+        import Mnemosyne
+        library = Mnemosyne.open_library('stress', index=False)
+        os.chdir(working_directory)
+        actual = {record['_id']: record['Comments'] for record in library.contents if record is not None}
+        expected = {}
+        for result in results:
+            expected.update(result['expected'])
+        lost = [record_id for record_id in expected if actual.get(record_id) != expected[record_id]]
+        unexpected = [record_id for record_id in actual if record_id not in expected]
+        total_commits = writers * commits
+        print(f'{writers} writers x {commits} commits ({storage} storage), {readers} readers: {elapsed:.2f} s, '
+            f'{total_commits/elapsed:.0f} commits/s, {sum(result["merges"] for result in results)} merged commits, {opens} reader opens')
+        if lost or unexpected:
+            print(f'FAILED: {len(lost)} records lost or wrong, {len(unexpected)} unexpected records.')
+            return False
+        print(f'OK: all {len(expected)} records present and correct.')
+        return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Mnemosyne benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    import_parser = subparsers.add_parser('import', help='import time of Mnemosyne.py with and without the GUI')
+    import_parser.add_argument('--runs', type=int, default=20)
+    suite_parser = subparsers.add_parser('suite', help='time library operations on synthetic libraries')
+    suite_parser.add_argument('--sizes', type=int, nargs='+', default=SUITE_SIZES)
+    suite_parser.add_argument('--repeats', type=int, default=20, help='samples per operation')
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--output', default=None, help='JSON results file (default: benchmark_<date>.json)')
+    compare_parser = subparsers.add_parser('compare', help='compare two saved suite results')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    stress_parser = subparsers.add_parser('stress', help='concurrent writers and readers on one library')
+    stress_parser.add_argument('--writers', type=int, default=8)
+    stress_parser.add_argument('--commits', type=int, default=50, help='commits per writer')
+    stress_parser.add_argument('--storage', choices=('json','journal','mmap','sqlite'), default='journal')
+    stress_parser.add_argument('--readers', type=int, default=2)
+    stress_parser.add_argument('--seed', type=int, default=0)
+    engines_parser = subparsers.add_parser('engines', help='the same library and operations on the json and sqlite engines')
+    engines_parser.add_argument('--sizes', type=int, nargs='+', default=ENGINE_SIZES)
+    engines_parser.add_argument('--repeats', type=int, default=20, help='samples per operation')
+    engines_parser.add_argument('--seed', type=int, default=0)
+    engines_parser.add_argument('--output', default=None, help='JSON results file (not saved by default)')
+    args = parser.parse_args()
+
+    if args.benchmark == 'import':
+        benchmark_import(args.runs)
+    elif args.benchmark == 'suite':
+        results = run_suite(args.sizes, args.repeats, args.seed)
+        output = args.output or time.strftime('benchmark_%Y%m%d_%H%M%S.json')
+        with open(output,'w') as output_file:
+            json.dump(results,output_file,indent=4)
+        print(f'Results saved to {output}.')
+    elif args.benchmark == 'compare':
+        compare(args.old, args.new)
+    elif args.benchmark == 'stress':
+        if not run_stress(args.writers, args.commits, args.storage, args.readers, args.seed):
+            sys.exit(1)
+    elif args.benchmark == 'engines':
+        results = run_engines(args.sizes, args.repeats, args.seed)
+        if args.output:
+            with open(args.output,'w') as output_file:
+                json.dump(results,output_file,indent=4)
+            print(f'Results saved to {args.output}.')
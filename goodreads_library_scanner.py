@@ -1,67 +1,248 @@
 # Extracts data from a goodreads csv file to add to library.json.
+# The export is streamed: rows are read back in blocks from the end of the file, converted one at a
+# time and written out in batches, so memory use stays flat however large the export is.
+# Each record keeps its goodreads Book Id and a hash of its row as hidden metadata, so that a library
+# can later be brought up to date with a newer export by applying only what changed (sync_goodreads).
 
 import csv
+import hashlib
 import json
-from Mnemosyne import create_library
-
-
-print('Goodreads library scanner for Mnemosyne (works as of August 2024)')
-library_name = ' '
-while ' ' in library_name or len(library_name.strip()) == 0:
-    library_name = input('Enter the name of your new library (must be a valid filename, no spaces): ')
-
-gr_file = open('goodreads_library_export.csv', newline='', encoding='utf8')
-next(gr_file) # skips first line
-gr_lib = list(csv.reader(gr_file, delimiter=','))
-gr_lib.reverse()
-
-print('Do you want to import read or unread books to your Mnemosyne library?')
-scan_type = -1
-while scan_type not in (0, 1, 2):
-    scan_type = input('Enter 0 for unread, 1 for read, 2 for both:')
-    try:
-        scan_type = int(scan_type)
-    except:
-        scan_type = -1
-if scan_type == 0:
-    scan_for_read = 0
-    scan_for_unread = 1
-elif scan_type == 1:
-    scan_for_read = 1
-    scan_for_unread = 0
-else:
-    scan_for_read = 1
-    scan_for_unread = 1
-
-library_data = []
-
-print('Scanning...')
-
-for item in gr_lib:
-    gr_readcount = int(item[22]) # Will be 0 if book is unread, 1 or more otherwise
-    if int(item[22]) > 0:
-        book_is_read = 1
-        book_is_unread = 0
+from Mnemosyne import check_valid_library, create_library, open_library
+from mnemosyne_dedupe import DuplicateIndex
+from mnemosyne_storage import snapshot_writer
+
+GOODREADS_FILENAME = 'goodreads_library_export.csv'
+
+# Goodreads column for each Mnemosyne field (columns are found by name in the header):
+FIELD_COLUMNS = {
+    'Title':'Title',
+    'Attribution':'Author',
+    'Rating':'My Rating',
+    'Edition Notes':'Publisher',
+    'Comments':'My Review'
+    }
+READ_COUNT_COLUMN = 'Read Count'
+BOOK_ID_COLUMN = 'Book Id'
+
+# Rows held in memory at once while reading the file backwards:
+BLOCK_ROWS = 1000
+# Records written to the library file at a time:
+BATCH_SIZE = 1000
+
+
+# Yields (offset, row) for each csv row from the current position of the binary file gr_file,
+# where offset is the byte offset just past the row.
+# csv.reader only pulls the lines it needs for each row, so the offsets stay exact even when
+# quoted fields (reviews, mostly) span several lines.
+def rows_with_offsets(gr_file):
+    consumed = [gr_file.tell()]
+    def lines():
+        for line in iter(gr_file.readline, b''):
+            consumed[0] += len(line)
+            yield line.decode('utf8')
+    for row in csv.reader(lines(), delimiter=','):
+        yield consumed[0], row
+
+# Reads the header row and returns a map from column name to column position:
+def read_columns(gr_file):
+    header = next(csv.reader([gr_file.readline().decode('utf-8-sig')], delimiter=','))
+    columns = {name: position for position, name in enumerate(header)}
+    missing = [name for name in list(FIELD_COLUMNS.values()) + [READ_COUNT_COLUMN, BOOK_ID_COLUMN] if name not in columns]
+    if missing:
+        raise ValueError(f'goodreads export is missing columns: {", ".join(missing)}')
+    return columns
+
+# Yields the rows after the header from last to first (goodreads lists the newest books first).
+# A forward pass notes where every BLOCK_ROWS-th row starts; the blocks are then read back in reverse,
+# so only one block and the list of block offsets are ever in memory.
+def reversed_rows(gr_file):
+    block_starts = [gr_file.tell()]
+    for count, (offset, row) in enumerate(rows_with_offsets(gr_file), 1):
+        if count % BLOCK_ROWS == 0:
+            block_starts.append(offset)
+    block_ends = block_starts[1:] + [None]
+    for start, end in reversed(list(zip(block_starts, block_ends))):
+        gr_file.seek(start)
+        block = []
+        for offset, row in rows_with_offsets(gr_file):
+            block.append(row)
+            if offset == end:
+                break
+        yield from reversed(block)
+
+# Converts goodreads rows to Mnemosyne records, skipping books the user didn't ask for.
+# The Book Id of every row, skipped or not, is added to book_ids if given.
+def records_from_rows(rows, columns, scan_for_read, scan_for_unread, book_ids=None):
+    for row in rows:
+        # Skip blank lines:
+        if not row:
+            continue
+        if book_ids is not None:
+            book_ids.add(row[columns[BOOK_ID_COLUMN]])
+        # Read count will be 0 if book is unread, 1 or more otherwise
+        book_is_read = int(row[columns[READ_COUNT_COLUMN]]) > 0
+        if (book_is_read and not scan_for_read) or (not book_is_read and not scan_for_unread):
+            continue
+        record = {field: row[columns[column]] for field, column in FIELD_COLUMNS.items()}
+        record['Rating'] = int(record['Rating'])
+        record['_goodreads_id'] = row[columns[BOOK_ID_COLUMN]]
+        record['_goodreads_hash'] = row_hash(record)
+        yield record
+
+# Hash of the fields a row gives a record, to tell whether the row changed since the last import:
+def row_hash(record):
+    fields = json.dumps([record[field] for field in FIELD_COLUMNS], ensure_ascii=False)
+    return hashlib.blake2b(fields.encode('utf8'), digest_size=8).hexdigest()
+
+# Imports the export into a new library and returns (books imported, duplicates found).
+# duplicates says what happens to a book that duplicates one imported before it (see mnemosyne_dedupe.py):
+# 'keep' imports it as it is, 'flag' imports it with the id of the first copy as _duplicate_of,
+# 'skip' leaves it out.
+def import_goodreads(filename, library_name, scan_for_read, scan_for_unread, duplicates='keep'):
+    with open(filename,'rb') as gr_file:
+        columns = read_columns(gr_file)
+        records = records_from_rows(reversed_rows(gr_file), columns, scan_for_read, scan_for_unread)
+        new_library = create_library(library_name)
+        writer = snapshot_writer(new_library.filename, new_library.file_format)
+        seen = DuplicateIndex() if duplicates != 'keep' else None
+        found = 0
+        batch = []
+        record_id = 0
+        for record in records:
+            if seen is not None:
+                original_id = seen.find(record)
+                if original_id is not None:
+                    found += 1
+                    if duplicates == 'skip':
+                        continue
+                    record['_duplicate_of'] = original_id
+                else:
+                    seen.add(record_id, record)
+            record['_id'] = record_id
+            record_id += 1
+            batch.append(record)
+            if len(batch) == BATCH_SIZE:
+                writer.write_batch(batch)
+                batch = []
+        writer.write_batch(batch)
+        writer.close()
+    return writer.count, found
+
+# Brings an existing library up to date with a newer export, in a single commit: books new to the
+# export are added (oldest first), books whose row changed are updated from it, and books imported
+# before but no longer in the export at all are deleted. Books left out by scan_for_read/scan_for_unread
+# are neither added nor deleted, so syncing only unread books leaves read books imported before alone.
+# Rows are matched to records by Book Id and compared by hash, so unchanged books are left alone and
+# only the changes are written. Records without a Book Id (imported before Book Ids were kept, or
+# added in Mnemosyne itself) that match a row by title and author (see mnemosyne_dedupe.py) are only
+# linked to it: they get its Book Id and hash but keep their own fields, and from then on are synced
+# like any other imported book. Other records without a Book Id are never touched.
+# If given, confirm_deletions(number of books to delete) is asked before any are deleted, and the
+# deletions are left out if it returns False.
+# Returns (added, updated, deleted).
+def sync_goodreads(filename, library_name, scan_for_read, scan_for_unread, confirm_deletions=None):
+    library = open_library(library_name, index=False)
+    by_goodreads_id = {}
+    without_id = DuplicateIndex()
+    for record in library.contents:
+        if record is None:
+            continue
+        goodreads_id = record.get('_goodreads_id')
+        if goodreads_id is None:
+            without_id.add(record['_id'], record)
+        else:
+            by_goodreads_id[goodreads_id] = record['_id']
+    in_export = set()
+    matched = set()
+    added = 0
+    updated = 0
+    with open(filename,'rb') as gr_file:
+        columns = read_columns(gr_file)
+        for record in records_from_rows(reversed_rows(gr_file), columns, scan_for_read, scan_for_unread, in_export):
+            goodreads_id = record['_goodreads_id']
+            record_id = by_goodreads_id.get(goodreads_id)
+            if record_id is None:
+                record_id = without_id.find(record)
+                if record_id is not None and record_id not in matched:
+                    matched.add(record_id)
+                    linked_record = library.records[record_id].copy()
+                    linked_record['_goodreads_id'] = goodreads_id
+                    linked_record['_goodreads_hash'] = record['_goodreads_hash']
+                    library.update_entry(record_id, linked_record)
+                    continue
+                library.insert_entry(record)
+                added += 1
+                continue
+            matched.add(record_id)
+            if library.records[record_id].get('_goodreads_hash') != record['_goodreads_hash']:
+                changed_record = library.records[record_id].copy()
+                for field, entry in record.items():
+                    changed_record[field] = entry
+                library.update_entry(record_id, changed_record)
+                updated += 1
+    removed = [record_id for goodreads_id, record_id in by_goodreads_id.items() if goodreads_id not in in_export]
+    if removed and confirm_deletions and not confirm_deletions(len(removed)):
+        removed = []
+    for record_id in removed:
+        library.delete_entry(record_id)
+    deleted = len(removed)
+    library.commit()
+    library.sync()
+    return added, updated, deleted
+
+
+if __name__ == '__main__':
+    print('Goodreads library scanner for Mnemosyne (works as of August 2024)')
+    library_name = ' '
+    while ' ' in library_name or len(library_name.strip()) == 0:
+        library_name = input('Enter the name of your new library (must be a valid filename, no spaces), or of a library imported before to bring it up to date: ')
+    sync = check_valid_library(library_name)
+    if sync:
+        print(f'{library_name} already exists: it will be synced with the export (only new, changed and removed books are applied).')
+
+    print('Do you want to import read or unread books to your Mnemosyne library?')
+    scan_type = -1
+    while scan_type not in (0, 1, 2):
+        scan_type = input('Enter 0 for unread, 1 for read, 2 for both:')
+        try:
+            scan_type = int(scan_type)
+        except:
+            scan_type = -1
+    if scan_type == 0:
+        scan_for_read = 0
+        scan_for_unread = 1
+    elif scan_type == 1:
+        scan_for_read = 1
+        scan_for_unread = 0
     else:
-        book_is_read = 0
-        book_is_unread = 1
-    if (scan_for_unread != book_is_unread) and (scan_for_read != book_is_read):
-        continue
-    entry = {}
-    entry['title'] = item[1]
-    entry['attribution'] = item[2]
-    entry['rating'] = int(item[7])
-    entry['edition_notes'] = item[9]
-    entry['comments'] = item[19]
-    library_data.append(entry)
-
-print('Writing...')
-
-new_library = create_library(library_name)
-new_library.contents.append(library_data)
-new_library.commit()
-
-print('Done.')
+        scan_for_read = 1
+        scan_for_unread = 1
+
+    if sync:
+        # Books gone from the export are only deleted if the user agrees:
+        def confirm_deletions(count):
+            print(f'{count} books imported before are no longer in the export. Delete them from {library_name}?')
+            confirmation = input('y/n: ')
+            if confirmation.strip().lower() != 'y':
+                print('Nothing deleted.')
+                return False
+            return True
+        print('Syncing...')
+        added, updated, deleted = sync_goodreads(GOODREADS_FILENAME, library_name, scan_for_read, scan_for_unread, confirm_deletions)
+        print(f'Done. {added} books added, {updated} updated, {deleted} deleted.')
+    else:
+        print('What should happen to books that appear more than once in the export (same title and author)?')
+        duplicates = ''
+        while duplicates not in ('keep', 'flag', 'skip'):
+            duplicates = input('Enter keep to import them anyway, flag to import and mark them, skip to leave them out: ').strip().lower()
+
+        print('Scanning and writing...')
+
+        imported, found = import_goodreads(GOODREADS_FILENAME, library_name, scan_for_read, scan_for_unread, duplicates)
+
+        print(f'Done. {imported} books imported.')
+        if found:
+            print(f'{found} duplicates {"skipped" if duplicates == "skip" else "found"}. Use the dedupe command in Mnemosyne to review duplicates.')
 
 # GOODREADS LIBRARY EXPORT CSV FILE FORMAT
 # ALL LINES:
@@ -0,0 +1,107 @@
+# Background autosave for the interactive librarian.
+# Instead of committing after every edit before the next prompt, the REPL asks the autosaver to
+# save. A background thread waits until no change has come in for AUTOSAVE_DELAY seconds, so a
+# burst of edits is written in one commit, then commits the library.
+# The library is only ever changed under Autosaver.lock: the REPL holds it while running a command,
+# so a save never sees a command half done (the prompt itself, where the user spends their time,
+# doesn't hold it). The thread only holds it to take the changes to save (Library.take_commit);
+# writing them out is done without it (Library.write_commit), so a command typed meanwhile doesn't
+# wait for the disk. Errors from the thread are kept for the REPL to report; the changes stay
+# pending and are saved again with the next one.
+
+import threading
+import time
+
+AUTOSAVE_DELAY = 1.0
+
+
+class Autosaver:
+    # With profile, the thread runs under a cProfile profiler of its own (a profiler only sees the
+    # thread that enables it), left in self.profiler for --profile to add to the main thread's.
+    def __init__(self, delay=AUTOSAVE_DELAY, profile=False):
+        self.delay = delay
+        self.profile = profile
+        self.profiler = None
+        self.lock = threading.RLock()
+        self.library = None
+        self.last_request = 0
+        self.requested = threading.Event()
+        self.stopped = threading.Event()
+        self.errors = []
+        self.thread = threading.Thread(target=self.run, name='autosave', daemon=True)
+        self.thread.start()
+
+    # Asks for the library to be saved soon (call with the lock held):
+    def request(self, library):
+        self.library = library
+        self.last_request = time.monotonic()
+        self.requested.set()
+
+    def run(self):
+        if self.profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Only one profiler can be active from Python 3.12 on, and it sees every thread:
+                self.profiler = None
+        try:
+            self.save_when_asked()
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+
+    def save_when_asked(self):
+        while not self.stopped.is_set():
+            self.requested.wait()
+            # Wait for a pause in the changes:
+            while not self.stopped.is_set():
+                remaining = self.last_request + self.delay - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.stopped.wait(remaining)
+            if self.stopped.is_set():
+                return
+            self.requested.clear()
+            with self.lock:
+                library = self.library
+                try:
+                    taken = library.take_commit() if library is not None else None
+                except Exception as error:
+                    self.errors.append(error)
+                    continue
+            if taken is None:
+                continue
+            try:
+                written = library.write_commit(taken)
+            except Exception as error:
+                with self.lock:
+                    self.errors.append(error)
+                continue
+            with self.lock:
+                try:
+                    # Another process committed to the library meanwhile, so it has to be merged:
+                    if not written:
+                        library.commit()
+                except Exception as error:
+                    self.errors.append(error)
+                # A journal that has grown too long is folded into a snapshot straight away:
+                if written and library.needs_snapshot:
+                    self.requested.set()
+
+    # Returns (and forgets) the errors from saves since the last call:
+    def take_errors(self):
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+        return errors
+
+    # Stops the thread, waiting for a save in progress, and saves anything still pending.
+    # Errors from this last save are raised.
+    def close(self):
+        self.stopped.set()
+        self.requested.set()
+        self.thread.join()
+        if self.library is not None:
+            self.library.commit()
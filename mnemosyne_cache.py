@@ -0,0 +1,66 @@
+# Cache of search results for a library, so repeated searches don't search again.
+# Entries are keyed by (kind of search, field, normalized query) and hold the ids found, in display
+# order, plus a function telling whether a record could be found by that search.
+# When a record is inserted, edited or deleted, only the entries it affects are dropped: those that
+# found the record before the change, and those whose search would find it after.
+# The least recently used entries are dropped once there are more than QUERY_CACHE_SIZE of them,
+# or once they hold more than QUERY_CACHE_IDS ids between them.
+
+from collections import OrderedDict
+
+QUERY_CACHE_SIZE = 128
+QUERY_CACHE_IDS = 1000000
+
+
+class QueryCache:
+    def __init__(self, size=QUERY_CACHE_SIZE, max_ids=QUERY_CACHE_IDS):
+        self.size = size
+        self.max_ids = max_ids
+        # key -> (ids, set of ids, matches(record))
+        self.entries = OrderedDict()
+        self.ids = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    # Returns the cached ids for key, or None:
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, record_ids, matches):
+        if len(record_ids) > self.max_ids:
+            return
+        if key in self.entries:
+            self.drop(key)
+        self.entries[key] = (record_ids, set(record_ids), matches)
+        self.ids += len(record_ids)
+        while len(self.entries) > self.size or self.ids > self.max_ids:
+            self.drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def drop(self, key):
+        record_ids, id_set, matches = self.entries.pop(key)
+        self.ids -= len(record_ids)
+
+    # Drops the entries affected by a change to a record (record is None for a deletion):
+    def invalidate(self, record_id, record=None):
+        affected = [key for key, (record_ids, id_set, matches) in self.entries.items()
+            if record_id in id_set or (record is not None and matches(record))]
+        for key in affected:
+            self.drop(key)
+        self.invalidations += len(affected)
+
+    def clear(self):
+        self.entries.clear()
+        self.ids = 0
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
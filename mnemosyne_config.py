@@ -0,0 +1,110 @@
+# Registry of the libraries listed in config.json.
+# The file is read once and kept as a list (in file order) plus a name -> entry dict, so lookups
+# don't touch the disk. Every access checks the file's stat first and reloads it if something else
+# (another Mnemosyne, a text editor) changed it. Writes are atomic and only happen on a real change.
+
+import json
+import os
+from mnemosyne_storage import replace_file
+
+CONFIG_FILENAME = 'config.json'
+
+
+class ConfigRegistry:
+    def __init__(self, filename=CONFIG_FILENAME):
+        self.filename = filename
+        self.entries = []
+        self.by_name = {}
+        # (inode, mtime, size) of the file as last read or written, None if there was no file:
+        self.stamp = None
+
+    def file_stamp(self):
+        try:
+            stat = os.stat(self.filename)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    # Reloads the file if it changed since it was last read or written:
+    def refresh(self):
+        stamp = self.file_stamp()
+        if stamp == self.stamp:
+            return
+        if stamp is None:
+            self.entries = []
+        else:
+            with open(self.filename,'r') as config_file:
+                self.entries = json.load(config_file)
+        self.by_name = {entry['name']: entry for entry in self.entries}
+        self.stamp = stamp
+
+    def exists(self):
+        self.refresh()
+        return self.stamp is not None
+
+    def __contains__(self, library_name):
+        self.refresh()
+        return library_name in self.by_name
+
+    # Returns the entry for a library, or None if it isn't registered:
+    def get(self, library_name):
+        self.refresh()
+        return self.by_name.get(library_name)
+
+    def names(self):
+        self.refresh()
+        return [entry['name'] for entry in self.entries]
+
+    def default_name(self):
+        self.refresh()
+        for entry in self.entries:
+            if entry.get('is_default'):
+                return entry['name']
+        return None
+
+    # Registers a new library (the first one becomes the default):
+    def add(self, library_name):
+        self.refresh()
+        if library_name in self.by_name:
+            return
+        entry = {'name':library_name,'is_default':len(self.entries) == 0}
+        self.entries.append(entry)
+        self.by_name[library_name] = entry
+        self.save()
+
+    def set_default(self, library_name):
+        self.refresh()
+        changed = False
+        for entry in self.entries:
+            is_default = entry['name'] == library_name
+            if entry.get('is_default') != is_default:
+                entry['is_default'] = is_default
+                changed = True
+        if changed:
+            self.save()
+
+    # Changes settings of a registered library (None removes a setting):
+    def update(self, library_name, **settings):
+        self.refresh()
+        entry = self.by_name[library_name]
+        changed = False
+        for setting, value in settings.items():
+            if value is None:
+                if setting in entry:
+                    del entry[setting]
+                    changed = True
+            elif entry.get(setting) != value:
+                entry[setting] = value
+                changed = True
+        if changed:
+            self.save()
+
+    # Writes the entries to a temp file and swaps it in, so config.json is never half-written:
+    def save(self):
+        temp_filename = self.filename+'.tmp'
+        with open(temp_filename,'w') as config_file:
+            json.dump(self.entries,config_file,indent=4)
+            config_file.flush()
+            os.fsync(config_file.fileno())
+        replace_file(temp_filename, self.filename)
+        self.stamp = self.file_stamp()
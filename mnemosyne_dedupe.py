@@ -0,0 +1,176 @@
+# Duplicate detection for Mnemosyne libraries.
+# Two records are duplicates when their titles and attributions are the same once normalized, or
+# close enough to be the same book entered differently:
+# - titles are compared without case, accents, punctuation, a leading or trailing article or a
+#   subtitle (after ':' or '('), and may differ by a typo per 10 characters
+# - attributions must have the same surname ("J.R.R. Tolkien", "Tolkien, J. R. R." and "JRR Tolkien"
+#   all have surname tolkien) and, where both have one, the same first initial
+# Only records with the same surname are ever compared (they form a block), so the work grows with
+# the library rather than with its square. Within a block, finding every duplicate uses a sorted
+# neighbourhood: titles are sorted, forwards and by their reversed text, and each is compared with
+# the next DEDUPE_WINDOW - 1, which catches typos anywhere in the title. Checking one record (as an
+# import goes along) uses pieces of the titles instead: a title allowed n typos is split into n + 1
+# pieces, n typos can't change all of them, so only titles sharing a whole piece (at about the same
+# place) are compared, however big the block.
+
+import re
+import unicodedata
+from mnemosyne_index import edit_distance
+
+# Titles each title is compared with in a sorted block (including itself):
+DEDUPE_WINDOW = 5
+ARTICLES = ('the', 'a', 'an')
+NAME_SUFFIXES = ('jr', 'sr', 'ii', 'iii', 'iv', 'phd')
+NON_WORD = re.compile(r'[\W_]+')
+# Separators between several authors (only the first author counts):
+AUTHOR_SEPARATOR = re.compile(r'\s+(?:and|&)\s+|;|/')
+
+
+# Lowercase words without accents or punctuation, separated by single spaces:
+def fold(text):
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+    return NON_WORD.sub(' ', text.lower()).strip()
+
+def title_key(title):
+    main_title = re.split(r'[:(]', title, 1)[0]
+    words = fold(main_title if main_title.strip() else title).split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    elif len(words) > 1 and words[-1] in ARTICLES:
+        words = words[:-1]
+    return ' '.join(words)
+
+# (first initial, surname) of the first author; the initial is '' when there is only a surname:
+def author_key(attribution):
+    author = AUTHOR_SEPARATOR.split(attribution, 1)[0]
+    if ',' in author:
+        surname, first_names = author.split(',', 1)
+        author = f'{first_names} {surname}'
+    words = [word for word in fold(author).split() if word not in NAME_SUFFIXES]
+    if len(words) == 0:
+        return ('', '')
+    return (words[0][0] if len(words) > 1 else '', words[-1])
+
+# Typos allowed between two title keys:
+def title_typos(title, other_title):
+    return max(len(title), len(other_title)) // 10
+
+# Most typos a title of this length can be allowed against any title close enough in length to match:
+def most_typos(length):
+    return (length + length // 9 + 1) // 10
+
+# (start, end) of the pieces a title of this length is split into, one more than its most typos:
+def title_pieces(length):
+    count = most_typos(length) + 1
+    size = length // count
+    return [(piece * size, length if piece == count - 1 else (piece + 1) * size) for piece in range(count)]
+
+def similar_titles(title, other_title):
+    if title == other_title:
+        return len(title) > 0
+    typos = title_typos(title, other_title)
+    return typos > 0 and edit_distance(title, other_title, typos) <= typos
+
+def same_author(initial, other_initial):
+    return initial == other_initial or initial == '' or other_initial == ''
+
+
+# Normalized keys of a library's records, grouped into blocks by surname.
+# Records can be added one at a time (as an import goes along) and checked against those already in.
+class DuplicateIndex:
+    def __init__(self, records=()):
+        # surname -> list of (title key, initial, record id)
+        self.blocks = {}
+        # (surname, title key) -> list of (initial, record id), for the common exact case
+        self.exact = {}
+        # (surname, title length, piece number, piece) -> positions in the surname's block, for find().
+        # Only built by the first find, then kept up to date.
+        self.pieces = None
+        for record in records:
+            self.add(record['_id'], record)
+
+    def add(self, record_id, record):
+        title = title_key(record['Title'])
+        initial, surname = author_key(record['Attribution'])
+        block = self.blocks.setdefault(surname, [])
+        block.append((title, initial, record_id))
+        self.exact.setdefault((surname, title), []).append((initial, record_id))
+        if self.pieces is not None:
+            self.add_pieces(surname, title, len(block) - 1)
+
+    def add_pieces(self, surname, title, position):
+        # Titles allowed no typos can only match exactly:
+        if most_typos(len(title)) == 0:
+            return
+        for piece, (start, end) in enumerate(title_pieces(len(title))):
+            self.pieces.setdefault((surname, len(title), piece, title[start:end]), []).append(position)
+
+    # Positions in the surname's block of the titles that may be within their allowed typos of title:
+    # those with a piece that is in title, moved by no more than the typos allowed. Some piece is
+    # unchanged with no more typos before it than pieces before it, and no more after it than
+    # pieces after it, which bounds how far it can have moved (see Li et al., "PassJoin", 2011).
+    def candidates(self, title, surname):
+        if self.pieces is None:
+            self.pieces = {}
+            for block_surname, block in self.blocks.items():
+                for position, (block_title, initial, record_id) in enumerate(block):
+                    self.add_pieces(block_surname, block_title, position)
+        positions = set()
+        reach = most_typos(len(title))
+        for length in range(max(1, len(title) - reach), len(title) + reach + 1):
+            typos = max(len(title), length) // 10
+            if typos == 0 or abs(len(title) - length) > typos:
+                continue
+            pieces = title_pieces(length)
+            difference = len(title) - length
+            for piece, (start, end) in enumerate(pieces):
+                after = len(pieces) - 1 - piece
+                lowest = max(0, start - piece, start + difference - after)
+                highest = min(len(title) - (end - start), start + piece, start + difference + after)
+                for shift in range(lowest, highest + 1):
+                    positions.update(self.pieces.get((surname, length, piece, title[shift:shift+end-start]), ()))
+        return sorted(positions)
+
+    # Returns the id of a record already in that record duplicates, or None:
+    def find(self, record):
+        title = title_key(record['Title'])
+        initial, surname = author_key(record['Attribution'])
+        if len(title) == 0:
+            return None
+        for other_initial, other_id in self.exact.get((surname, title), ()):
+            if same_author(initial, other_initial):
+                return other_id
+        block = self.blocks.get(surname, ())
+        for position in self.candidates(title, surname):
+            other_title, other_initial, other_id = block[position]
+            if same_author(initial, other_initial) and similar_titles(title, other_title):
+                return other_id
+        return None
+
+    # Returns the groups of duplicate records, as lists of record ids (groups of one are left out):
+    def clusters(self):
+        # Union-find over the records found to be duplicates:
+        parent = {}
+        def root(record_id):
+            while record_id in parent:
+                record_id = parent[record_id]
+            return record_id
+        linked = set()
+        for block in self.blocks.values():
+            if len(block) < 2:
+                continue
+            for ordering in (sorted(block), sorted(block, key=lambda entry: entry[0][::-1])):
+                for position, (title, initial, record_id) in enumerate(ordering):
+                    for other_title, other_initial, other_id in ordering[position+1:position+DEDUPE_WINDOW]:
+                        if same_author(initial, other_initial) and similar_titles(title, other_title):
+                            record_root, other_root = root(record_id), root(other_id)
+                            if record_root != other_root:
+                                parent[other_root] = record_root
+                            linked.add(record_id)
+                            linked.add(other_id)
+        groups = {}
+        for record_id in linked:
+            groups.setdefault(root(record_id), []).append(record_id)
+        return list(groups.values())
@@ -0,0 +1,77 @@
+# Tk windows used by Mnemosyne.py for creating and editing records.
+# Imported on demand so the rest of Mnemosyne works without tkinter or a display.
+
+import tkinter as tk
+
+
+class InputWindow(tk.Tk):
+    def __init__(self, existing_entry=''):
+        super().__init__()
+        self.title('Input Window')
+
+        self.label = tk.Label(self, text='Enter your input:')
+        self.label.pack()
+
+        self.entry = tk.Text(self)
+        self.entry.insert(tk.END, existing_entry)
+        self.entry.pack()
+
+        self.button = tk.Button(self, text='Done', command=self.save_input)
+        self.button.pack()
+
+    def save_input(self):
+        self.new_field_entry = self.entry.get(1.0,'end').strip()
+        # strip() to remove newline automatically added by tk.Text
+        self.destroy()
+
+class NewTextWindow(tk.Tk):
+    def __init__(self, title):
+        super().__init__()
+        self.title(title)
+
+        self.label = tk.Label(self, text='Enter new text info:')
+        self.label.pack()
+
+        self.text_title = tk.Entry(self)
+        self.text_title.pack()
+
+        self.attribution = tk.Entry(self)
+        self.attribution.pack()
+
+        self.rating = tk.Entry(self)
+        self.rating.pack()
+
+        self.edition_notes = tk.Text(self)
+        self.edition_notes.pack()
+
+        self.comments = tk.Text(self)
+        self.comments.pack()
+
+        self.button = tk.Button(self, text='Done', command=self.save_input)
+        self.button.pack()
+
+    def save_input(self):
+        self.new_title = self.text_title.get()
+        self.new_attribution = self.attribution.get()
+        self.new_rating = self.rating.get()
+        self.new_edition_notes = self.edition_notes.get(1.0,'end').strip()
+        self.new_comments = self.comments.get(1.0,'end').strip()
+        # strip() to remove newline automatically added by tk.Text
+        self.destroy()
+
+class ErrorWindow(tk.Tk):
+    def __init__(self, error):
+        super().__init__()
+        self.title('Error')
+
+        self.label = tk.Label(self, text=error)
+        self.label.pack()
+
+        self.button = tk.Button(self, text='Okay', command=self.destroy)
+        self.button.pack()
+
+# Create an instance of the InputWindow class:
+# input_window = InputWindow()
+# input_window.mainloop()
+# Access the user input after the window is closed:
+# print("User input:", input_window.new_field_entry)
@@ -0,0 +1,318 @@
+# Search index for Mnemosyne libraries.
+# Keeps token postings for the text fields and a sorted map for Rating so that
+# browse() only has to look at records that can actually match a query.
+# Each part is built from the library's records the first time a search needs it, so opening a
+# library costs nothing and a library only ever searched by title never indexes its comments.
+# Also keeps, once asked for, each field's records in sorted order with counts of each value, for
+# the sort and stats commands.
+
+import re
+from collections import Counter
+from bisect import bisect_left, bisect_right, insort
+
+TEXT_FIELDS = ('Title', 'Attribution', 'Edition Notes', 'Comments')
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def trigrams(token):
+    return {token[i:i+3] for i in range(len(token) - 2)}
+
+# Trigrams of the token padded with two spaces on each side, so that even short tokens and tokens
+# with a typo share most of their grams with the correct spelling:
+def padded_trigrams(token):
+    return trigrams('  '+token+'  ')
+
+# Levenshtein distance between a and b, or limit + 1 as soon as it is known to be over limit:
+def edit_distance(a, b, limit):
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    # Only cells within limit of the diagonal can be within the limit; the others are left at limit + 1:
+    beyond = limit + 1
+    previous = [j if j <= limit else beyond for j in range(len(b) + 1)]
+    for i, char_a in enumerate(a, 1):
+        low = max(1, i - limit)
+        high = min(len(b), i + limit)
+        current = [beyond] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        for j in range(low, high + 1):
+            distance = previous[j-1] + (char_a != b[j-1])
+            if previous[j] + 1 < distance:
+                distance = previous[j] + 1
+            if current[j-1] + 1 < distance:
+                distance = current[j-1] + 1
+            current[j] = min(distance, beyond)
+        if min(current[low-1:high+1]) > limit:
+            return beyond
+        previous = current
+    return previous[-1]
+
+
+# Index for a single text field.
+# Records are split into lowercase word tokens. Substring queries are answered by finding every
+# token in the vocabulary that contains each word fragment of the query (through a trigram index
+# over the vocabulary, which is far smaller than the records themselves) and intersecting their
+# postings. browse() still checks each candidate with the original substring test.
+# Nothing is kept per record: removing a record takes the string it was added with.
+class TokenIndex:
+    def __init__(self):
+        # token -> set of record keys
+        self.postings = {}
+        # trigram -> set of tokens in the vocabulary
+        self.trigrams = {}
+        # padded trigram -> set of tokens, for typo-tolerant lookups (see similar_tokens).
+        # Only built by the first ranked search, then kept up to date.
+        self.fuzzy_grams = None
+
+    def add(self, key, string):
+        for token in set(TOKEN_PATTERN.findall(string.lower())):
+            keys = self.postings.get(token)
+            if keys is None:
+                self.postings[token] = {key}
+                for gram in trigrams(token):
+                    self.trigrams.setdefault(gram, set()).add(token)
+                if self.fuzzy_grams is not None:
+                    for gram in padded_trigrams(token):
+                        self.fuzzy_grams.setdefault(gram, set()).add(token)
+            else:
+                keys.add(key)
+
+    def remove(self, key, string):
+        for token in set(TOKEN_PATTERN.findall(string.lower())):
+            keys = self.postings[token]
+            keys.discard(key)
+            # Drop tokens that no longer occur anywhere from the vocabulary:
+            if not keys:
+                del self.postings[token]
+                for gram in trigrams(token):
+                    vocabulary = self.trigrams[gram]
+                    vocabulary.discard(token)
+                    if not vocabulary:
+                        del self.trigrams[gram]
+                if self.fuzzy_grams is not None:
+                    for gram in padded_trigrams(token):
+                        vocabulary = self.fuzzy_grams[gram]
+                        vocabulary.discard(token)
+                        if not vocabulary:
+                            del self.fuzzy_grams[gram]
+
+    def tokens_containing(self, fragment):
+        # Fragments shorter than a trigram are rare and match most of the vocabulary anyway:
+        if len(fragment) < 3:
+            return [token for token in self.postings if fragment in token]
+        candidates = None
+        for gram in sorted(trigrams(fragment), key=lambda gram: len(self.trigrams.get(gram, ()))):
+            vocabulary = self.trigrams.get(gram)
+            if not vocabulary:
+                return []
+            candidates = set(vocabulary) if candidates is None else candidates & vocabulary
+        return [token for token in candidates if fragment in token]
+
+    # Returns {token: distance} for the tokens in the vocabulary within max_distance edits of token.
+    # One edit changes at most three padded trigrams, so only tokens sharing enough grams with
+    # token are compared.
+    def similar_tokens(self, token, max_distance):
+        if self.fuzzy_grams is None:
+            self.fuzzy_grams = {}
+            for known in self.postings:
+                for gram in padded_trigrams(known):
+                    self.fuzzy_grams.setdefault(gram, set()).add(known)
+        grams = padded_trigrams(token)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.fuzzy_grams.get(gram, ()))
+        similar = {}
+        for known, count in shared.items():
+            if count >= len(grams) - 3 * max_distance:
+                distance = edit_distance(token, known, max_distance)
+                if distance <= max_distance:
+                    similar[known] = distance
+        return similar
+
+    # Splits query into (whole tokens, fragments of tokens), or returns None if it has no word characters.
+    # A fragment with non-word characters on both sides must be a whole token in the record.
+    # Any other fragment may be part of a longer token.
+    def fragments(self, query):
+        query = query.lower()
+        fragments = list(TOKEN_PATTERN.finditer(query))
+        if not fragments:
+            return None
+        exact = set()
+        partial = set()
+        for fragment in fragments:
+            if fragment.start() > 0 and fragment.end() < len(query):
+                exact.add(fragment.group())
+            else:
+                partial.add(fragment.group())
+        return exact, partial
+
+    # Upper bound on the number of keys candidates(query) returns, worked out from the vocabulary
+    # without building any set of keys (None if the query has no word characters):
+    def estimate(self, query):
+        fragments = self.fragments(query)
+        if fragments is None:
+            return None
+        exact, partial = fragments
+        sizes = [len(self.postings.get(token, ())) for token in exact]
+        sizes += [sum(len(self.postings[token]) for token in self.tokens_containing(fragment)) for fragment in partial]
+        return min(sizes)
+
+    # Returns the set of keys that may contain query, or None if the query has no word characters
+    # (in which case the caller has to fall back to a scan).
+    def candidates(self, query):
+        fragments = self.fragments(query)
+        if fragments is None:
+            return None
+        exact, partial = fragments
+        postings = [self.postings.get(token, set()) for token in exact]
+        for fragment in partial:
+            keys = set()
+            for token in self.tokens_containing(fragment):
+                keys |= self.postings[token]
+            postings.append(keys)
+        # Intersect from the smallest set so work stays proportional to the number of hits:
+        postings.sort(key=len)
+        result = set(postings[0])
+        for keys in postings[1:]:
+            if not result:
+                break
+            result &= keys
+        return result
+
+
+# Index for Rating: a map from rating to record keys plus the sorted list of ratings in use.
+class RatingIndex:
+    def __init__(self):
+        self.postings = {}
+        self.sorted_ratings = []
+
+    def add(self, key, rating):
+        keys = self.postings.get(rating)
+        if keys is None:
+            self.postings[rating] = {key}
+            insort(self.sorted_ratings, rating)
+        else:
+            keys.add(key)
+
+    def remove(self, key, rating):
+        keys = self.postings[rating]
+        keys.discard(key)
+        if not keys:
+            del self.postings[rating]
+            self.sorted_ratings.pop(bisect_left(self.sorted_ratings, rating))
+
+    def lookup(self, rating):
+        return self.postings.get(rating, set())
+
+    def ratings_between(self, low=None, high=None):
+        start = 0 if low is None else bisect_left(self.sorted_ratings, low)
+        stop = len(self.sorted_ratings) if high is None else bisect_right(self.sorted_ratings, high)
+        return self.sorted_ratings[start:stop]
+
+    # All keys with low <= rating <= high (either bound may be None):
+    def lookup_range(self, low=None, high=None):
+        keys = set()
+        for rating in self.ratings_between(low, high):
+            keys |= self.postings[rating]
+        return keys
+
+    # Number of keys lookup_range(low, high) returns:
+    def count_range(self, low=None, high=None):
+        return sum(len(self.postings[rating]) for rating in self.ratings_between(low, high))
+
+
+# Records in order of one field (text without case, ties in the order the records were added), for
+# sorted listings, plus how many records have each value of the field.
+# The order is kept as a sorted list of (sort key, record key) and a list of just the record keys,
+# which a listing can copy in one go. Changes are found with bisect, so they cost a list insert.
+class SortedIndex:
+    def __init__(self, field, records=()):
+        self.field = field
+        self.sort_key_of = {key: self.sort_key(record) for key, record in records}
+        self.entries = sorted((sort_key, key) for key, sort_key in self.sort_key_of.items())
+        self.keys = [key for sort_key, key in self.entries]
+        self.counts = Counter(self.value(sort_key) for sort_key in self.sort_key_of.values())
+
+    # (folded value, value) for text, so the original value is still at hand for counting:
+    def sort_key(self, record):
+        value = record[self.field]
+        return (value.lower(), value) if isinstance(value, str) else value
+
+    def value(self, sort_key):
+        return sort_key[1] if isinstance(sort_key, tuple) else sort_key
+
+    def add(self, key, record):
+        sort_key = self.sort_key(record)
+        self.sort_key_of[key] = sort_key
+        position = bisect_left(self.entries, (sort_key, key))
+        self.entries.insert(position, (sort_key, key))
+        self.keys.insert(position, key)
+        self.counts[self.value(sort_key)] += 1
+
+    def remove(self, key):
+        if key not in self.sort_key_of:
+            return
+        sort_key = self.sort_key_of.pop(key)
+        position = bisect_left(self.entries, (sort_key, key))
+        del self.entries[position]
+        del self.keys[position]
+        value = self.value(sort_key)
+        self.counts[value] -= 1
+        if self.counts[value] == 0:
+            del self.counts[value]
+
+
+# records is the library's own map of key -> record, which the parts of the index are built from.
+# The library tells the index about every change after making it in records, passing the record
+# as it was before (update and remove), so parts not built yet can simply ignore the change.
+class LibraryIndex:
+    def __init__(self, records):
+        self.records = records
+        # field -> TokenIndex, built by the first search of the field (see field):
+        self.fields = {}
+        # RatingIndex, built by the first search of Rating (see ratings):
+        self._ratings = None
+        # field -> SortedIndex, built by the first sorted listing or count of a field (see sorted_by):
+        self.sorted = {}
+
+    def field(self, field):
+        field_index = self.fields.get(field)
+        if field_index is None:
+            field_index = self.fields[field] = TokenIndex()
+            for key, record in self.records.items():
+                field_index.add(key, record[field])
+        return field_index
+
+    @property
+    def ratings(self):
+        if self._ratings is None:
+            self._ratings = RatingIndex()
+            for key, record in self.records.items():
+                self._ratings.add(key, record['Rating'])
+        return self._ratings
+
+    def add(self, key, record):
+        for field, field_index in self.fields.items():
+            field_index.add(key, record[field])
+        if self._ratings is not None:
+            self._ratings.add(key, record['Rating'])
+        for sorted_index in self.sorted.values():
+            sorted_index.add(key, record)
+
+    def remove(self, key, record):
+        for field, field_index in self.fields.items():
+            field_index.remove(key, record[field])
+        if self._ratings is not None:
+            self._ratings.remove(key, record['Rating'])
+        for sorted_index in self.sorted.values():
+            sorted_index.remove(key)
+
+    def sorted_by(self, field):
+        sorted_index = self.sorted.get(field)
+        if sorted_index is None:
+            sorted_index = self.sorted[field] = SortedIndex(field, self.records.items())
+        return sorted_index
+
+    def update(self, key, old_record, record):
+        self.remove(key, old_record)
+        self.add(key, record)
@@ -0,0 +1,97 @@
+# Timings and counters for the librarian, shown by the stats command.
+# Every command is timed, and so are the steps where a session spends its time: parsing queries,
+# searching, printing the display (which builds the Texts it shows) and committing. Each time goes
+# into a histogram of LATENCY_BUCKETS for its name, and, with --timing-log, is also written to a
+# file as a line of JSON, e.g.
+#     {"time": 1760000000.123, "name": "search", "ms": 3.217, "command": "search"}
+# Counters keep totals that aren't times (Texts built, lines printed, ...).
+# Recording a time costs about a microsecond, so it is always on.
+
+import json
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in milliseconds (the last bucket takes everything slower):
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Width of the longest bar in a printed histogram:
+HISTOGRAM_WIDTH = 40
+
+
+class Timings:
+    def __init__(self):
+        # name -> [count, total ms, max ms, bucket counts]
+        self.timings = {}
+        self.counters = {}
+        # The command being run, added to logged times:
+        self.command = None
+        self.log_file = None
+
+    # Appends every time recorded from now on to filename as JSON lines:
+    def open_log(self, filename):
+        self.close_log()
+        self.log_file = open(filename, 'a', encoding='utf8', buffering=1)
+
+    def close_log(self):
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+
+    def record(self, name, seconds):
+        milliseconds = seconds * 1000
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = [0, 0.0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+        timing[0] += 1
+        timing[1] += milliseconds
+        timing[2] = max(timing[2], milliseconds)
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and milliseconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        timing[3][bucket] += 1
+        if self.log_file:
+            entry = {'time':round(time.time(), 3), 'name':name, 'ms':round(milliseconds, 3)}
+            if self.command:
+                entry['command'] = self.command
+            self.log_file.write(json.dumps(entry) + '\n')
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    # Times a whole librarian command (the steps timed inside it are logged with its name):
+    @contextmanager
+    def timed_command(self, user_input):
+        self.command = user_input.split(None, 1)[0]
+        try:
+            with self.timed(f'command {self.command}'):
+                yield
+        finally:
+            self.command = None
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def clear(self):
+        self.timings.clear()
+        self.counters.clear()
+
+    # Lines describing the timings so far: a summary and a histogram per name, then the counters.
+    def report(self):
+        lines = []
+        for name in sorted(self.timings):
+            count, total, longest, buckets = self.timings[name]
+            lines.append(f'{name}: {count} times, mean {total/count:.3f} ms, max {longest:.3f} ms')
+            most = max(buckets)
+            for bucket, bucket_count in enumerate(buckets):
+                if bucket_count == 0:
+                    continue
+                label = f'<= {LATENCY_BUCKETS[bucket]:g} ms' if bucket < len(LATENCY_BUCKETS) else f'> {LATENCY_BUCKETS[-1]:g} ms'
+                bar = '#' * max(1, round(bucket_count / most * HISTOGRAM_WIDTH))
+                lines.append(f'  {label:>11} {bar} {bucket_count}')
+        if self.counters:
+            lines.append('Counters: ' + ', '.join(f'{name} {value}' for name, value in sorted(self.counters.items())))
+        return lines
@@ -0,0 +1,241 @@
+# Compound search queries, e.g.
+#     search a:tolkien r>=4 -c:reread
+#     search (a:"le guin" OR a:lewis) AND NOT t:earthsea
+# A condition is a field abbreviation, an operator and a value. Text fields take ':' and match
+# like search does (case-insensitive substring); quote values that contain spaces or brackets.
+# Rating takes ':' or '=' for an exact rating, or '<', '<=', '>', '>='.
+# Conditions next to each other (or joined with AND) must all hold; OR binds looser than AND;
+# NOT or a leading '-' negates a condition or a bracketed group.
+#
+# Before running, the query is planned against the library's index: every condition gets an
+# estimate of how many records it can match, worked out from the index without touching records.
+# An AND group only fetches the candidates of its most selective condition and checks the others
+# on those records, most selective first, so a query costs about as much as its cheapest condition.
+
+import re
+
+FIELD_ABBREVIATIONS = {
+    't':'Title',
+    'a':'Attribution',
+    'n':'Edition Notes',
+    'c':'Comments',
+    'r':'Rating'
+    }
+
+QUERY_TOKEN = re.compile(r'\s*(?:(?P<open>\()|(?P<close>\))|(?P<minus>-)(?=[^\s)])'
+    r'|(?P<field>\w+)(?P<operator>>=|<=|[:=<>])(?P<value>"[^"]*"|[^\s()"]*)|(?P<word>[^\s()]+))')
+
+
+class Condition:
+    def __init__(self, field, operator, value):
+        self.field = field
+        if field == 'Rating':
+            try:
+                rating = int(value)
+            except ValueError:
+                raise ValueError('Invalid query (rating must be an integer).')
+            self.low, self.high = {
+                ':':(rating, rating), '=':(rating, rating),
+                '>=':(rating, None), '>':(rating + 1, None),
+                '<=':(None, rating), '<':(None, rating - 1)
+                }[operator]
+        else:
+            if operator != ':':
+                raise ValueError(f'Invalid query ({operator} only works for ratings).')
+            if len(value) == 0:
+                raise ValueError('Invalid query (empty search term).')
+            self.value = value.lower()
+
+    # Normalized form of the query, for caching results:
+    def key(self):
+        if self.field == 'Rating':
+            return f'Rating:{self.low}..{self.high}'
+        return f'{self.field}:{self.value!r}'
+
+    # Number of records this can match (at most total):
+    def plan(self, library, total):
+        if self.field == 'Rating':
+            self.estimate = library.index.ratings.count_range(self.low, self.high)
+        else:
+            estimate = library.index.field(self.field).estimate(self.value)
+            self.estimate = total if estimate is None else min(estimate, total)
+        return self.estimate
+
+    # Set of ids that may match, or None for every record:
+    def candidates(self, library):
+        if self.field == 'Rating':
+            return library.index.ratings.lookup_range(self.low, self.high)
+        return library.index.field(self.field).candidates(self.value)
+
+    def matches(self, record):
+        if self.field == 'Rating':
+            rating = record['Rating']
+            return (self.low is None or rating >= self.low) and (self.high is None or rating <= self.high)
+        return self.value in record[self.field].lower()
+
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+    def key(self):
+        return f'NOT {self.child.key()}'
+
+    def plan(self, library, total):
+        self.child.plan(library, total)
+        self.estimate = total
+        return self.estimate
+
+    def candidates(self, library):
+        return None
+
+    def matches(self, record):
+        return not self.child.matches(record)
+
+
+class And:
+    def __init__(self, children):
+        self.children = children
+
+    def key(self):
+        return '(' + ' AND '.join(sorted(child.key() for child in self.children)) + ')'
+
+    # Orders the conditions from most to least selective:
+    def plan(self, library, total):
+        for child in self.children:
+            child.plan(library, total)
+        self.children.sort(key=lambda child: child.estimate)
+        self.estimate = self.children[0].estimate
+        return self.estimate
+
+    # Only the most selective condition that can use the index is looked up:
+    def candidates(self, library):
+        for child in self.children:
+            if not isinstance(child, Not):
+                return child.candidates(library)
+        return None
+
+    def matches(self, record):
+        for child in self.children:
+            if not child.matches(record):
+                return False
+        return True
+
+
+class Or:
+    def __init__(self, children):
+        self.children = children
+
+    def key(self):
+        return '(' + ' OR '.join(sorted(child.key() for child in self.children)) + ')'
+
+    # Orders the conditions from least to most selective, so matches() can stop early:
+    def plan(self, library, total):
+        for child in self.children:
+            child.plan(library, total)
+        self.children.sort(key=lambda child: child.estimate, reverse=True)
+        self.estimate = min(total, sum(child.estimate for child in self.children))
+        return self.estimate
+
+    def candidates(self, library):
+        keys = set()
+        for child in self.children:
+            child_keys = child.candidates(library)
+            if child_keys is None:
+                return None
+            keys |= child_keys
+        return keys
+
+    def matches(self, record):
+        for child in self.children:
+            if child.matches(record):
+                return True
+        return False
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = QUERY_TOKEN.match(text, position)
+        position = match.end()
+        if match['open']:
+            tokens.append(('(', None))
+        elif match['close']:
+            tokens.append((')', None))
+        elif match['minus']:
+            tokens.append(('NOT', None))
+        elif match['field']:
+            abbreviation = match['field']
+            if abbreviation not in FIELD_ABBREVIATIONS:
+                raise ValueError(f'Invalid query (unknown field {abbreviation}).')
+            value = match['value']
+            if value.startswith('"'):
+                value = value[1:-1]
+            tokens.append(('condition', Condition(FIELD_ABBREVIATIONS[abbreviation], match['operator'], value)))
+        elif match['word'].upper() in ('AND', 'OR', 'NOT'):
+            tokens.append((match['word'].upper(), None))
+        else:
+            raise ValueError(f'Invalid query (expected field:value, got {match["word"]}).')
+    return tokens
+
+# Parses a query into a tree of Condition, Not, And and Or.
+# Raises ValueError with a message for the user if the query is invalid.
+def parse_query(text):
+    tokens = tokenize(text)
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def parse_or():
+        nonlocal position
+        children = [parse_and()]
+        while peek() == 'OR':
+            position += 1
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and():
+        nonlocal position
+        children = [parse_not()]
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                position += 1
+            children.append(parse_not())
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_not():
+        nonlocal position
+        kind = peek()
+        if kind == 'NOT':
+            position += 1
+            return Not(parse_not())
+        if kind == '(':
+            position += 1
+            node = parse_or()
+            if peek() != ')':
+                raise ValueError('Invalid query (missing closing bracket).')
+            position += 1
+            return node
+        if kind == 'condition':
+            position += 1
+            return tokens[position - 1][1]
+        if kind is None:
+            raise ValueError('Invalid query (missing condition).')
+        raise ValueError(f'Invalid query (unexpected {kind}).')
+
+    node = parse_or()
+    if position < len(tokens):
+        raise ValueError(f'Invalid query (unexpected {peek()}).')
+    return node
+
+# Returns the ids of the records in library matching the parsed query, in library order:
+def run_query(node, library):
+    node.plan(library, len(library.positions))
+    candidates = node.candidates(library)
+    if candidates is None:
+        candidates = library.positions
+    found = [record_id for record_id in candidates if node.matches(library.records[record_id])]
+    return sorted(found, key=library.positions.__getitem__)
@@ -0,0 +1,128 @@
+# Ranked (fuzzy) search for Mnemosyne libraries.
+# Records are scored against the query and only the best k are kept, in a heap of size k, so the
+# work after scoring and the size of the result depend on k rather than on how many records match.
+#
+# Score of a field value (higher is better):
+# - 3 for an exact match, 2 if the value starts with the query, 1 if it contains it anywhere
+# - plus the share of query words found in the value: 1 per word present as a whole word,
+#   0.75 as the start of a word, 0.5 / typos for a word within a few typos, 0.25 inside a word
+# Ties go to the shorter value, then to the record earlier in the library.
+
+import heapq
+from mnemosyne_index import TOKEN_PATTERN, edit_distance
+
+# Results kept by a ranked search:
+RANKED_RESULTS = 20
+
+
+# Typos allowed in a query word, by length:
+def max_typos(token):
+    if len(token) <= 3:
+        return 0
+    if len(token) <= 7:
+        return 1
+    return 2
+
+def score(value, query, query_tokens, similar):
+    value = value.lower()
+    if value == query:
+        total = 3.0
+    elif value.startswith(query):
+        total = 2.0
+    elif query in value:
+        total = 1.0
+    else:
+        total = 0.0
+    if query_tokens:
+        tokens = set(TOKEN_PATTERN.findall(value))
+        overlap = 0.0
+        for query_token in query_tokens:
+            if query_token in tokens:
+                overlap += 1.0
+            elif any(token.startswith(query_token) for token in tokens):
+                overlap += 0.75
+            else:
+                typos = min((similar[query_token][token] for token in tokens if token in similar[query_token]), default=0)
+                if typos:
+                    overlap += 0.5 / typos
+                elif any(query_token in token for token in tokens):
+                    overlap += 0.25
+        total += overlap / len(query_tokens)
+    return total
+
+# Whether a record with this field value is scored by rank() at all (for keeping cached results
+# up to date): it contains the query, or has a word containing or close to a word of the query.
+def could_match(value, query):
+    value = value.lower()
+    query = query.lower()
+    if query in value:
+        return True
+    tokens = TOKEN_PATTERN.findall(value)
+    for query_token in TOKEN_PATTERN.findall(query):
+        typos = max_typos(query_token)
+        for token in tokens:
+            if query_token in token or edit_distance(query_token, token, typos) <= typos:
+                return True
+    return False
+
+# Returns the ids of the k records of library whose field best matches query, best first.
+# Only records sharing at least one (possibly misspelt) word with the query are scored; queries
+# without any word characters score every record.
+def rank(field, query, library, k=RANKED_RESULTS):
+    query = query.lower()
+    query_tokens = list(dict.fromkeys(TOKEN_PATTERN.findall(query)))
+    field_index = library.index.field(field)
+    similar = {}
+    if query_tokens:
+        candidates = set()
+        for query_token in query_tokens:
+            similar[query_token] = field_index.similar_tokens(query_token, max_typos(query_token))
+            for token in field_index.tokens_containing(query_token) + list(similar[query_token]):
+                candidates |= field_index.postings[token]
+    else:
+        candidates = [record['_id'] for record in library.contents if record is not None]
+    entries = ((record_id, library.positions[record_id], library.records[record_id][field]) for record_id in candidates)
+    return best_entries(entries, query, query_tokens, similar, k)
+
+# Keeps the k best of (id, position, value) entries, as ids, best first:
+def best_entries(entries, query, query_tokens, similar, k):
+    # Min-heap of the best k so far, as (score, -length, -position, id):
+    best = []
+    for record_id, position, value in entries:
+        points = score(value, query, query_tokens, similar)
+        if points == 0:
+            continue
+        entry = (points, -len(value), -position, record_id)
+        if len(best) < k:
+            heapq.heappush(best, entry)
+        elif entry > best[0]:
+            heapq.heapreplace(best, entry)
+    return [entry[3] for entry in sorted(best, reverse=True)]
+
+# Pieces of the query's words that any value scored by rank() contains: a word within n typos is
+# split into n + 1 pieces, and n typos can't change all of them. Empty for queries without words.
+def typo_fragments(query):
+    fragments = set()
+    for query_token in TOKEN_PATTERN.findall(query.lower()):
+        pieces = max_typos(query_token) + 1
+        size = len(query_token) // pieces
+        for piece in range(pieces):
+            fragments.add(query_token[piece*size:] if piece == pieces - 1 else query_token[piece*size:(piece+1)*size])
+    return sorted(fragments)
+
+# Ranks candidate (id, value) pairs, in library order, found without a token index (by the sqlite
+# engine or a scan of a mapped library, from typo_fragments): typos are looked for among the
+# candidates' own words.
+def rank_values(values, query, k=RANKED_RESULTS):
+    query = query.lower()
+    query_tokens = list(dict.fromkeys(TOKEN_PATTERN.findall(query)))
+    vocabulary = {token for record_id, value in values for token in TOKEN_PATTERN.findall(value.lower())}
+    similar = {}
+    for query_token in query_tokens:
+        typos = max_typos(query_token)
+        similar[query_token] = {}
+        for token in vocabulary:
+            distance = edit_distance(query_token, token, typos)
+            if distance <= typos:
+                similar[query_token][token] = distance
+    return best_entries(((record_id, position, value) for position, (record_id, value) in enumerate(values)), query, query_tokens, similar, k)
@@ -0,0 +1,124 @@
+# Compact in-memory representation of a Mnemosyne record.
+# A Record stores the five fields and the id in slots instead of a per-record dict, which takes about
+# a third of the memory, and interns attributions since the same authors recur across a library.
+# It still behaves like the JSON-shaped dict (record['Title'], record.items(), ...), so code written
+# against dicts keeps working; to_dict() returns the plain dict for anything that really needs one.
+
+import sys
+
+# Field name -> slot:
+FIELD_SLOTS = {
+    'Title':'title',
+    'Attribution':'attribution',
+    'Rating':'rating',
+    'Edition Notes':'edition_notes',
+    'Comments':'comments'
+    }
+
+
+class Record:
+    __slots__ = ('title', 'attribution', 'rating', 'edition_notes', 'comments', 'id', 'extra')
+
+    def __init__(self, title='', attribution='', rating=0, edition_notes='', comments='', id=None, extra=None):
+        self.title = title
+        self.attribution = sys.intern(attribution)
+        self.rating = rating
+        self.edition_notes = edition_notes
+        self.comments = comments
+        self.id = id
+        # Any other keys (metadata such as import ids), or None:
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, info):
+        extra = {key: entry for key, entry in info.items() if key not in FIELD_SLOTS and key != '_id'}
+        return cls(info.get('Title',''), info.get('Attribution',''), info.get('Rating',0),
+            info.get('Edition Notes',''), info.get('Comments',''), info.get('_id'), extra or None)
+
+    def to_dict(self):
+        info = {
+            'Title':self.title,
+            'Attribution':self.attribution,
+            'Rating':self.rating,
+            'Edition Notes':self.edition_notes,
+            'Comments':self.comments
+            }
+        if self.extra:
+            info.update(self.extra)
+        if self.id is not None:
+            info['_id'] = self.id
+        return info
+
+    def copy(self):
+        return Record(self.title, self.attribution, self.rating, self.edition_notes, self.comments,
+            self.id, dict(self.extra) if self.extra else None)
+
+    def __getitem__(self, field):
+        slot = FIELD_SLOTS.get(field)
+        if slot is not None:
+            return getattr(self, slot)
+        if field == '_id' and self.id is not None:
+            return self.id
+        if self.extra and field in self.extra:
+            return self.extra[field]
+        raise KeyError(field)
+
+    def __setitem__(self, field, entry):
+        slot = FIELD_SLOTS.get(field)
+        if slot == 'attribution':
+            self.attribution = sys.intern(entry)
+        elif slot is not None:
+            setattr(self, slot, entry)
+        elif field == '_id':
+            self.id = entry
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[field] = entry
+
+    def __delitem__(self, field):
+        if field == '_id' and self.id is not None:
+            self.id = None
+        elif self.extra and field in self.extra:
+            del self.extra[field]
+        else:
+            raise KeyError(field)
+
+    def __contains__(self, field):
+        return field in FIELD_SLOTS or (field == '_id' and self.id is not None) or bool(self.extra and field in self.extra)
+
+    def get(self, field, default=None):
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(FIELD_SLOTS) + (self.id is not None) + (len(self.extra) if self.extra else 0)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f'Record({self.to_dict()!r})'
+
+
+# For json.dump(..., default=json_default), so Records are written as the usual dicts:
+def json_default(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def as_record(info):
+    return info if isinstance(info, Record) else Record.from_dict(info)
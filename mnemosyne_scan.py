@@ -0,0 +1,76 @@
+# Parallel full scans for queries the search index can't answer (substrings without any word
+# characters, regular expressions).
+# The library is split into contiguous ranges of positions, one per worker process, and the matching
+# positions are concatenated in range order, so hits come back in the same order as a serial scan.
+# Where processes can be forked, the workers inherit the contents and only get (start, end) sent
+# to them; elsewhere each worker is sent just the searched field of its range.
+# Libraries smaller than PARALLEL_THRESHOLD are scanned serially: below that, starting the
+# workers costs more than the scan.
+# multiprocessing is only imported for a parallel scan, so that importing Mnemosyne stays quick.
+
+import os
+import re
+
+PARALLEL_THRESHOLD = 200000
+# Ranges per worker (a few, so one slow range doesn't hold everything up):
+RANGES_PER_WORKER = 4
+
+# Contents being scanned, inherited by forked workers:
+scan_contents = None
+
+
+# Returns a function telling whether a field value matches the query, like browse() does:
+# case-insensitive substring, or case-insensitive regular expression search.
+def matcher(query, regex=False):
+    if regex:
+        return re.compile(query, re.IGNORECASE).search
+    query = query.lower()
+    return lambda entry: query in entry.lower()
+
+# Serial scan of contents[start:end]:
+def scan_positions(contents, start, end, field, query, regex):
+    matches = matcher(query, regex)
+    positions = []
+    for position in range(start, end):
+        record = contents[position]
+        if record is not None and matches(str(record[field])):
+            positions.append(position)
+    return positions
+
+# Worker for forked processes, scanning the inherited contents:
+def scan_inherited(start, end, field, query, regex):
+    return scan_positions(scan_contents, start, end, field, query, regex)
+
+# Worker for other processes, scanning the field values sent to it:
+def scan_values(values, start, query, regex):
+    matches = matcher(query, regex)
+    return [position for position, entry in enumerate(values, start) if entry is not None and matches(str(entry))]
+
+# Returns the positions of the records in contents whose field matches query, in order.
+# Raises re.error for an invalid regular expression.
+def scan(contents, field, query, regex=False, processes=None):
+    global scan_contents
+    if regex:
+        # Fail here rather than in every worker:
+        re.compile(query)
+    processes = processes or os.cpu_count() or 1
+    if len(contents) < PARALLEL_THRESHOLD or processes < 2:
+        return scan_positions(contents, 0, len(contents), field, query, regex)
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    size = -(-len(contents) // (processes * RANGES_PER_WORKER))
+    ranges = [(start, min(start + size, len(contents))) for start in range(0, len(contents), size)]
+    if 'fork' in multiprocessing.get_all_start_methods():
+        scan_contents = contents
+        try:
+            with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('fork')) as pool:
+                futures = [pool.submit(scan_inherited, start, end, field, query, regex) for start, end in ranges]
+                return [position for future in futures for position in future.result()]
+        finally:
+            scan_contents = None
+    with ProcessPoolExecutor(processes) as pool:
+        futures = []
+        for start, end in ranges:
+            values = [None if contents[position] is None else contents[position][field] for position in range(start, end)]
+            futures.append(pool.submit(scan_values, values, start, query, regex))
+        return [position for future in futures for position in future.result()]
@@ -0,0 +1,314 @@
+# SQLite storage engine for Mnemosyne libraries (storage "sqlite" in config.json).
+# The library lives in <name>.sqlite and is queried where it is instead of being read into memory, so
+# opening a library takes the same time whatever its size, and a commit only writes the records that
+# changed. The database has:
+# - records: a row per record. The record id is the primary key and ids are never reused, so the
+#   order of the ids is the order of the library. Keys other than the five fields go in extra as JSON.
+# - indexes on lower_text(title), lower_text(attribution) and rating, for sorted listings and rating searches
+# - text: an FTS5 table over the four text fields using the trigram tokenizer, so a substring search
+#   only reads the rows that contain the query's trigrams. Triggers keep it in step with records.
+# lower_text is Python's str.lower: SQLite's lower() only folds ASCII and FTS5 folds case its own way,
+# so text is always lowercased by Python before it is compared, indexed or sorted.
+# The database runs in WAL mode, so readers (searchall, other Mnemosynes) never wait for a writer.
+# Searches match the same records as with the other engines: case-insensitive substrings, ratings by value.
+
+import json
+import sqlite3
+from mnemosyne_query import Condition, Not, And
+from mnemosyne_record import Record
+
+SQLITE_EXTENSION = '.sqlite'
+# Field -> column:
+COLUMNS = {
+    'Title':'title',
+    'Attribution':'attribution',
+    'Rating':'rating',
+    'Edition Notes':'edition_notes',
+    'Comments':'comments'
+    }
+# Fields searched through the text table:
+TEXT_FIELDS = ('Title', 'Attribution', 'Edition Notes', 'Comments')
+# Shortest query the trigram index can answer (shorter ones scan the column):
+TRIGRAM_LENGTH = 3
+# Rows inserted per statement batch by bulk_load:
+LOAD_BATCH = 10000
+# Version of SCHEMA, kept in the database's user_version. Version 0 indexed the text as it is
+# stored, with SQLite's own case folding (see SqliteStore.upgrade):
+SCHEMA_VERSION = 1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    attribution TEXT NOT NULL,
+    rating INTEGER NOT NULL,
+    edition_notes TEXT NOT NULL,
+    comments TEXT NOT NULL,
+    extra TEXT
+    );
+CREATE INDEX IF NOT EXISTS records_title ON records (lower_text(title), title, id);
+CREATE INDEX IF NOT EXISTS records_attribution ON records (lower_text(attribution), attribution, id);
+CREATE INDEX IF NOT EXISTS records_rating ON records (rating, id);
+CREATE VIRTUAL TABLE IF NOT EXISTS text USING fts5(title, attribution, edition_notes, comments, content='records', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS records_insert AFTER INSERT ON records BEGIN
+    INSERT INTO text (rowid, title, attribution, edition_notes, comments) VALUES (new.id, lower_text(new.title), lower_text(new.attribution), lower_text(new.edition_notes), lower_text(new.comments));
+END;
+CREATE TRIGGER IF NOT EXISTS records_delete AFTER DELETE ON records BEGIN
+    INSERT INTO text (text, rowid, title, attribution, edition_notes, comments) VALUES ('delete', old.id, lower_text(old.title), lower_text(old.attribution), lower_text(old.edition_notes), lower_text(old.comments));
+END;
+CREATE TRIGGER IF NOT EXISTS records_update AFTER UPDATE OF title, attribution, edition_notes, comments ON records BEGIN
+    INSERT INTO text (text, rowid, title, attribution, edition_notes, comments) VALUES ('delete', old.id, lower_text(old.title), lower_text(old.attribution), lower_text(old.edition_notes), lower_text(old.comments));
+    INSERT INTO text (rowid, title, attribution, edition_notes, comments) VALUES (new.id, lower_text(new.title), lower_text(new.attribution), lower_text(new.edition_notes), lower_text(new.comments));
+END;
+'''
+# Indexes and triggers of version 0 that SCHEMA replaces:
+VERSION_0_OBJECTS = '''
+DROP INDEX IF EXISTS records_title;
+DROP INDEX IF EXISTS records_attribution;
+DROP TRIGGER IF EXISTS records_insert;
+DROP TRIGGER IF EXISTS records_delete;
+DROP TRIGGER IF EXISTS records_update;
+'''
+RECORD_COLUMNS = 'id, title, attribution, rating, edition_notes, comments, extra'
+
+
+def row_record(row):
+    record_id, title, attribution, rating, edition_notes, comments, extra = row
+    return Record(title, attribution, rating, edition_notes, comments, record_id, json.loads(extra) if extra else None)
+
+def record_row(record):
+    extra = record.extra if isinstance(record, Record) else {key: entry for key, entry in record.items() if key not in COLUMNS and key != '_id'}
+    return (record['Title'], record['Attribution'], record['Rating'], record['Edition Notes'], record['Comments'],
+        json.dumps(extra, separators=(',',':')) if extra else None)
+
+# SQL for "lowercase column contains query" (query already lowercase).
+# Even an ASCII query needs Python's lower(): 'İ'.lower() starts with an i, for one.
+def contains(column, query, params):
+    params.append(query)
+    return f'instr(lower_text({column}), ?) > 0'
+
+# SQL for a text field containing query (already lowercase), through the text table where it helps:
+def text_condition(field, query, params):
+    column = COLUMNS[field]
+    if field in TEXT_FIELDS and len(query) >= TRIGRAM_LENGTH:
+        params.append(f'{column} : "' + query.replace('"', '""') + '"')
+        # The text table holds the lowercased text, so the trigram match finds every record that
+        # contains the query. FTS5 folds case a little further still, so it is checked exactly too:
+        return f'(id IN (SELECT rowid FROM text WHERE text MATCH ?) AND {contains(column, query, params)})'
+    return contains(column, query, params)
+
+def rating_condition(low, high, params):
+    if low is not None and high is not None:
+        params += [low, high]
+        return 'rating BETWEEN ? AND ?'
+    if low is not None:
+        params.append(low)
+        return 'rating >= ?'
+    if high is not None:
+        params.append(high)
+        return 'rating <= ?'
+    return '1'
+
+# SQL WHERE clause for a parsed compound query (see mnemosyne_query.py):
+def query_condition(node, params):
+    if isinstance(node, Condition):
+        if node.field == 'Rating':
+            return rating_condition(node.low, node.high, params)
+        return text_condition(node.field, node.value, params)
+    if isinstance(node, Not):
+        return f'NOT ({query_condition(node.child, params)})'
+    joiner = ' AND ' if isinstance(node, And) else ' OR '
+    return '(' + joiner.join(query_condition(child, params) for child in node.children) + ')'
+
+
+class SqliteStore:
+    # durability 'commit' syncs every commit to disk; 'batch' leaves that to the next checkpoint().
+    def __init__(self, filename, durability='commit'):
+        self.filename = filename
+        # The autosave thread commits on this connection too (never at the same time as the REPL):
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.connection.create_function('lower_text', 1, str.lower, deterministic=True)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=' + ('FULL' if durability == 'commit' else 'NORMAL'))
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self.connection.executescript(VERSION_0_OBJECTS)
+        self.connection.executescript(SCHEMA)
+        if version < SCHEMA_VERSION:
+            self.upgrade()
+
+    # Indexes the text of a version 0 database again, lowercased (SCHEMA has already replaced the
+    # indexes and triggers):
+    def upgrade(self):
+        self.connection.execute("INSERT INTO text (text) VALUES ('delete-all')")
+        self.connection.execute('INSERT INTO text (rowid, title, attribution, edition_notes, comments) SELECT id, lower_text(title), lower_text(attribution), lower_text(edition_notes), lower_text(comments) FROM records')
+        self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, record_id):
+        row = self.connection.execute(f'SELECT {RECORD_COLUMNS} FROM records WHERE id = ?', (record_id,)).fetchone()
+        return row_record(row) if row else None
+
+    def exists(self, record_id):
+        return self.connection.execute('SELECT 1 FROM records WHERE id = ?', (record_id,)).fetchone() is not None
+
+    def count(self):
+        return self.connection.execute('SELECT count(*) FROM records').fetchone()[0]
+
+    def ids(self):
+        return [row[0] for row in self.connection.execute('SELECT id FROM records ORDER BY id')]
+
+    # Every record in library order, read as it is used:
+    def records(self):
+        for row in self.connection.execute(f'SELECT {RECORD_COLUMNS} FROM records ORDER BY id'):
+            yield row_record(row)
+
+    # Changes join the open transaction; commit() makes them permanent.
+    def insert(self, record):
+        cursor = self.connection.execute('INSERT INTO records (title, attribution, rating, edition_notes, comments, extra) VALUES (?, ?, ?, ?, ?, ?)', record_row(record))
+        return cursor.lastrowid
+
+    def update(self, record_id, record):
+        self.connection.execute('UPDATE records SET title = ?, attribution = ?, rating = ?, edition_notes = ?, comments = ?, extra = ? WHERE id = ?', record_row(record) + (record_id,))
+
+    # Returns whether there was such a record:
+    def delete(self, record_id):
+        return self.connection.execute('DELETE FROM records WHERE id = ?', (record_id,)).rowcount > 0
+
+    def commit(self):
+        self.connection.commit()
+
+    # Forces commits made with 'batch' durability to disk:
+    def checkpoint(self):
+        self.connection.execute('PRAGMA wal_checkpoint(FULL)')
+
+    def vacuum(self):
+        self.connection.commit()
+        self.connection.execute('VACUUM')
+        self.connection.execute('PRAGMA optimize')
+
+    # Adds records keeping their ids (for migrating a library), in one transaction:
+    def bulk_load(self, records):
+        batch = []
+        for record in records:
+            if record is None:
+                continue
+            batch.append((record['_id'],) + record_row(record))
+            if len(batch) == LOAD_BATCH:
+                self.connection.executemany('INSERT INTO records (id, title, attribution, rating, edition_notes, comments, extra) VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+                batch = []
+        self.connection.executemany('INSERT INTO records (id, title, attribution, rating, edition_notes, comments, extra) VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+        self.connection.commit()
+
+    def ids_where(self, condition, params):
+        return [row[0] for row in self.connection.execute(f'SELECT id FROM records WHERE {condition} ORDER BY id', params)]
+
+    # Ids of the records whose field contains query (or has rating query), in library order:
+    def search(self, field, query):
+        params = []
+        if field == 'Rating':
+            return self.ids_where(rating_condition(query, query, params), params)
+        return self.ids_where(text_condition(field, query.lower(), params), params)
+
+    def query(self, node):
+        params = []
+        return self.ids_where(query_condition(node, params), params)
+
+    # Ids of the records for which matches(value of field) is true, checked in Python (for regular expressions):
+    def filter(self, field, matches):
+        column = COLUMNS[field]
+        return [record_id for record_id, value in self.connection.execute(f'SELECT id, {column} FROM records ORDER BY id') if matches(str(value))]
+
+    # (id, value of field) of the records whose field contains any of fragments (every record without fragments):
+    def values_containing(self, field, fragments):
+        column = COLUMNS[field]
+        params = []
+        condition = ' OR '.join(contains(column, fragment, params) for fragment in fragments) or '1'
+        return self.connection.execute(f'SELECT id, {column} FROM records WHERE {condition} ORDER BY id', params).fetchall()
+
+    # Ids in order of field (text without case, then as it is, ties in library order, as in SortedIndex
+    # in mnemosyne_index.py), through the column's index:
+    def sorted_ids(self, field, descending=False):
+        column = COLUMNS[field]
+        order = ' DESC' if descending else ''
+        key = column if field == 'Rating' else f'lower_text({column}){order}, {column}'
+        return [row[0] for row in self.connection.execute(f'SELECT id FROM records ORDER BY {key}{order}, id{order}')]
+
+    # {rating: number of records}, lowest rating first:
+    def rating_counts(self):
+        return dict(self.connection.execute('SELECT rating, count(*) FROM records GROUP BY rating ORDER BY rating'))
+
+    def attribution_count(self):
+        return self.connection.execute('SELECT count(DISTINCT attribution) FROM records').fetchone()[0]
+
+    # [(attribution, number of records)] for the limit attributions with the most records:
+    def top_attributions(self, limit):
+        return self.connection.execute('SELECT attribution, count(*) AS records FROM records GROUP BY attribution ORDER BY records DESC, attribution LIMIT ?', (limit,)).fetchall()
+
+
+# Views of the database shaped like the in-memory library (records: id -> record, positions: id -> position,
+# contents: the records in order), for the code that works on any library.
+
+class SqliteRecords:
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, record_id):
+        record = self.store.get(record_id)
+        if record is None:
+            raise KeyError(record_id)
+        return record
+
+    def get(self, record_id, default=None):
+        record = self.store.get(record_id)
+        return default if record is None else record
+
+    def __contains__(self, record_id):
+        return self.store.exists(record_id)
+
+    def __len__(self):
+        return self.store.count()
+
+    def __iter__(self):
+        return iter(self.store.ids())
+
+    def keys(self):
+        return self.store.ids()
+
+    def values(self):
+        return self.store.records()
+
+    def items(self):
+        return ((record['_id'], record) for record in self.store.records())
+
+
+# Library order is id order, so an id can stand in for the record's position:
+class SqlitePositions:
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, record_id):
+        return record_id
+
+    def __contains__(self, record_id):
+        return self.store.exists(record_id)
+
+    def __len__(self):
+        return self.store.count()
+
+    def __iter__(self):
+        return iter(self.store.ids())
+
+
+class SqliteContents:
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.count()
+
+    def __iter__(self):
+        return self.store.records()
@@ -0,0 +1,578 @@
+# Storage engines for Mnemosyne libraries.
+#
+# 'json' (default): the whole library is rewritten as pretty-printed JSON on every commit.
+# 'journal': the library file is a compact JSON snapshot, and each commit only appends the
+# records that changed (by record id) to <name>.journal. The journal is replayed on open and
+# folded into a fresh snapshot once it grows past a size limit.
+#
+# Snapshots are written in one of three formats ('format' in config.json):
+# 'pretty': indented JSON, for hand-editing (<name>.json, the default for json storage)
+# 'compact': JSON without whitespace (<name>.json, the default for journal storage)
+# 'binary': length-prefixed records followed by an offset table (<name>.mnemo), see below
+# The format of an existing file is detected when it is read, so changing the setting just
+# converts the library on its next full write.
+#
+# 'mmap' storage works like 'journal' on a binary snapshot, but the snapshot is memory-mapped
+# instead of read: records are only decoded when they are used (see MappedContents), so opening
+# a library takes the same time and memory however large it is.
+#
+# Snapshots are written to a temp file, fsynced and renamed over the library file, so a crash leaves
+# either the old or the new version. Older versions can be kept as <file>.1, <file>.2, ...
+# ('backups' in config.json). Journal appends are fsynced on every commit, or only every few commits
+# with 'durability': 'batch' (see Library.commit).
+#
+# Several processes can use a library at once. Commits hold an exclusive advisory lock on
+# <name>.lock, which also holds the library's generation: a counter bumped when a commit starts
+# and again when it ends. A writer that finds the generation changed since it read the library
+# merges its changes onto the newer state first (see Library.merge). Readers never take the lock;
+# they read the generation before and after loading and load again if it moved.
+
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from mnemosyne_record import Record, as_record, json_default
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where commits are not locked against other processes.
+    fcntl = None
+
+# Journal size (in bytes) past which commit() compacts it into a new snapshot.
+# Can be overridden per library with 'journal_limit' in config.json.
+JOURNAL_LIMIT = 4 * 1024 * 1024
+# With 'durability': 'batch', commits are only forced to disk every SYNC_EVERY commits
+# (overridden with 'sync_every' in config.json):
+SYNC_EVERY = 10
+
+FORMAT_EXTENSIONS = {'pretty':'.json', 'compact':'.json', 'binary':'.mnemo'}
+
+# Binary format:
+# BINARY_MAGIC
+# one entry per record: RECORD_HEADER (id, rating, byte lengths of the four text fields and of the
+#   extra metadata), then the UTF-8 text fields, then any other record keys as compact JSON
+# offset table: little-endian uint64 start offset of each record
+# id table: little-endian int64 id of each record
+# BINARY_TRAILER (start of the offset table, number of records, start of the id table,
+#   1 if the ids are in ascending order, random tag identifying this snapshot)
+# Version 1 files (no id table, trailer of offset table start and record count) can still be read.
+BINARY_MAGIC = b'MNEMOSYNE-BIN-2\n'
+BINARY_MAGIC_V1 = b'MNEMOSYNE-BIN-1\n'
+BINARY_FIELDS = ('Title','Attribution','Edition Notes','Comments')
+BINARY_KEYS = frozenset(BINARY_FIELDS + ('Rating','_id'))
+RECORD_HEADER = struct.Struct('<qqIIIII')
+BINARY_TRAILER = struct.Struct('<QQQQQ')
+BINARY_TRAILER_V1 = struct.Struct('<QQ')
+
+
+def encode_record(record):
+    strings = [record[field].encode() for field in BINARY_FIELDS]
+    if isinstance(record, Record):
+        extra = record.extra
+    else:
+        extra = {key: entry for key, entry in record.items() if key not in BINARY_KEYS}
+    extra = json.dumps(extra,separators=(',',':')).encode() if extra else b''
+    return RECORD_HEADER.pack(record['_id'], record['Rating'], *map(len, strings), len(extra)) + b''.join(strings) + extra
+
+def decode_record(data, offset):
+    record_id, rating, title_length, attribution_length, notes_length, comments_length, extra_length = RECORD_HEADER.unpack_from(data, offset)
+    start = offset + RECORD_HEADER.size
+    end = start + title_length
+    title = str(data[start:end], 'utf8')
+    start, end = end, end + attribution_length
+    attribution = str(data[start:end], 'utf8')
+    start, end = end, end + notes_length
+    edition_notes = str(data[start:end], 'utf8')
+    start, end = end, end + comments_length
+    extra = json.loads(data[end:end+extra_length]) if extra_length else None
+    return Record(title, attribution, rating, edition_notes, str(data[start:end], 'utf8'), record_id, extra)
+
+def is_binary(data):
+    return data[:len(BINARY_MAGIC)] in (BINARY_MAGIC, BINARY_MAGIC_V1)
+
+# A table of count 64-bit integers in data. On little-endian machines this is a view straight
+# into data (or a memory map of the file), so nothing is copied.
+def read_table(data, start, count, typecode):
+    if sys.byteorder == 'little':
+        return memoryview(data)[start:start + 8*count].cast(typecode)
+    table = array(typecode)
+    table.frombytes(data[start:start + 8*count])
+    table.byteswap()
+    return table
+
+# Returns the offset table, id table, whether the ids are ascending, and the snapshot tag of a binary snapshot:
+def read_binary_tables(data):
+    if data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        table_offset, count, ids_offset, ascending, tag = BINARY_TRAILER.unpack_from(data, len(data) - BINARY_TRAILER.size)
+        return read_table(data, table_offset, count, 'Q'), read_table(data, ids_offset, count, 'q'), bool(ascending), tag
+    # Version 1 has no id table, so the ids come from the record headers:
+    table_offset, count = BINARY_TRAILER_V1.unpack_from(data, len(data) - BINARY_TRAILER_V1.size)
+    offsets = read_table(data, table_offset, count, 'Q')
+    ids = array('q', (RECORD_HEADER.unpack_from(data, offset)[0] for offset in offsets))
+    ascending = all(ids[position] < ids[position+1] for position in range(len(ids)-1))
+    return offsets, ids, ascending, zlib.crc32(data)
+
+def read_snapshot(filename):
+    with open(filename,'rb') as snapshot_file:
+        data = snapshot_file.read()
+    # The tag ties a journal to the snapshot it was written against:
+    # (a checksum for JSON snapshots, a random tag stored in the file for binary ones).
+    if is_binary(data):
+        offsets, ids, ascending, tag = read_binary_tables(data)
+        return [decode_record(data, offset) for offset in offsets], tag
+    return json.loads(data), zlib.crc32(data)
+
+def is_binary_file(filename):
+    with open(filename,'rb') as snapshot_file:
+        return is_binary(snapshot_file.read(len(BINARY_MAGIC)))
+
+# Returns the file a library should be read from: normally the one for its configured format, but after
+# the format setting changes the old file is still the current one until the next full write.
+def find_library_file(name, file_format):
+    filenames = [name + FORMAT_EXTENSIONS[file_format]]
+    filenames += [name + extension for extension in set(FORMAT_EXTENSIONS.values()) if name + extension not in filenames]
+    existing = [filename for filename in filenames if os.path.exists(filename)]
+    if not existing:
+        raise FileNotFoundError(filenames[0])
+    return max(existing, key=os.path.getmtime)
+
+# Makes a rename or a newly created file in the directory of filename survive a power cut.
+# (Only POSIX systems can fsync a directory.)
+def fsync_directory(filename):
+    if os.name != 'posix':
+        return
+    directory = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+# Keeps the current filename as filename.1, the one before as filename.2, ... up to filename.<backups>:
+def rotate_backups(filename, backups):
+    for number in range(backups - 1, 0, -1):
+        if os.path.exists(f'{filename}.{number}'):
+            os.replace(f'{filename}.{number}', f'{filename}.{number + 1}')
+    try:
+        os.remove(f'{filename}.1')
+    except FileNotFoundError:
+        pass
+    # A hard link keeps filename in place until the new version replaces it:
+    try:
+        os.link(filename, f'{filename}.1')
+    except OSError:
+        shutil.copy2(filename, f'{filename}.1')
+
+# Swaps a completely written and fsynced temp file in for filename, keeping backups of the old
+# versions if asked to. sync also makes the swap itself durable.
+def replace_file(temp_filename, filename, backups=0, sync=True):
+    if backups and os.path.exists(filename):
+        rotate_backups(filename, backups)
+    os.replace(temp_filename, filename)
+    if sync:
+        fsync_directory(filename)
+
+# Writes a JSON list of records to filename one batch at a time, so the whole list never has to be
+# held in memory. The records go to a temp file that is only swapped in on close(), after an fsync,
+# so a crash never leaves half a library (see replace_file for backups and sync).
+class SnapshotWriter:
+    def __init__(self, filename, indent=None, backups=0, sync=True):
+        self.filename = filename
+        self.temp_filename = filename+'.tmp'
+        self.indent = indent
+        self.backups = backups
+        self.sync = sync
+        self.snapshot_file = open(self.temp_filename,'wb')
+        self.crc = 0
+        self.count = 0
+
+    def write(self, string):
+        data = string.encode()
+        self.snapshot_file.write(data)
+        # The checksum ties a journal to the snapshot it was written against:
+        self.crc = zlib.crc32(data, self.crc)
+
+    def write_batch(self, records):
+        if not records:
+            return
+        if self.indent is None:
+            chunks = [json.dumps(record,separators=(',',':'),default=json_default) for record in records]
+            opening, separator = '[', ','
+        else:
+            # Same layout as json.dump(contents, indent=indent):
+            padding = ' ' * self.indent
+            chunks = [padding + json.dumps(record,indent=self.indent,default=json_default).replace('\n','\n'+padding) for record in records]
+            opening, separator = '[\n', ',\n'
+        self.write((separator if self.count else opening) + separator.join(chunks))
+        self.count += len(records)
+
+    def close(self):
+        if self.count == 0:
+            self.write('[]')
+        else:
+            self.write(']' if self.indent is None else '\n]')
+        self.snapshot_file.flush()
+        os.fsync(self.snapshot_file.fileno())
+        self.snapshot_file.close()
+        replace_file(self.temp_filename, self.filename, self.backups, self.sync)
+        return self.crc
+
+class BinarySnapshotWriter:
+    def __init__(self, filename, backups=0, sync=True):
+        self.filename = filename
+        self.temp_filename = filename+'.tmp'
+        self.backups = backups
+        self.sync = sync
+        self.snapshot_file = open(self.temp_filename,'wb')
+        self.crc = 0
+        self.count = 0
+        self.position = 0
+        self.offsets = array('Q')
+        self.ids = array('q')
+        self.write(BINARY_MAGIC)
+
+    def write(self, data):
+        self.snapshot_file.write(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.position += len(data)
+
+    def write_batch(self, records):
+        chunks = []
+        position = self.position
+        for record in records:
+            chunk = encode_record(record)
+            self.offsets.append(position)
+            self.ids.append(record['_id'])
+            position += len(chunk)
+            chunks.append(chunk)
+        self.write(b''.join(chunks))
+        self.count += len(records)
+
+    # Writes the tables and trailer. Once close() has returned, the file can be swapped in with replace().
+    def finish(self):
+        ascending = all(self.ids[position] < self.ids[position+1] for position in range(len(self.ids)-1))
+        # Random, rather than a checksum, so a mapped snapshot never has to be read in full:
+        self.tag = int.from_bytes(os.urandom(8), 'little') >> 1
+        table_offset = self.position
+        ids_offset = table_offset + 8*self.count
+        if sys.byteorder == 'big':
+            self.offsets.byteswap()
+            self.ids.byteswap()
+        self.write(self.offsets.tobytes())
+        self.write(self.ids.tobytes())
+        self.write(BINARY_TRAILER.pack(table_offset, self.count, ids_offset, ascending, self.tag))
+        self.snapshot_file.flush()
+        os.fsync(self.snapshot_file.fileno())
+        self.snapshot_file.close()
+
+    def replace(self):
+        replace_file(self.temp_filename, self.filename, self.backups, self.sync)
+        return self.tag
+
+    def close(self):
+        self.finish()
+        return self.replace()
+
+def snapshot_writer(filename, file_format, backups=0, sync=True):
+    if file_format == 'binary':
+        return BinarySnapshotWriter(filename, backups, sync)
+    return SnapshotWriter(filename, 4 if file_format == 'pretty' else None, backups, sync)
+
+# Writes contents (skipping deleted records) and returns the new snapshot's tag:
+def write_snapshot(filename, contents, file_format='compact', batch_size=1000, backups=0, sync=True):
+    writer = snapshot_writer(filename, file_format, backups, sync)
+    write_records(writer, contents, batch_size)
+    return writer.close()
+
+def write_records(writer, contents, batch_size=1000):
+    batch = []
+    for record in contents:
+        if record is None:
+            continue
+        batch.append(record)
+        if len(batch) == batch_size:
+            writer.write_batch(batch)
+            batch = []
+    writer.write_batch(batch)
+
+# Memory-mapped binary snapshot, used as Library.contents by 'mmap' storage.
+# Behaves like the list of records: a record is decoded from the map each time it is accessed, and
+# only records that were changed since the snapshot was written are kept in memory.
+class MappedContents:
+    def __init__(self, filename):
+        self.filename = filename
+        self.load()
+
+    def load(self):
+        self.snapshot_file = open(self.filename,'rb')
+        self.map = mmap.mmap(self.snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets, self.ids, self.ascending, self.tag = read_binary_tables(self.map)
+        self.base_count = len(self.offsets)
+        # Changes since the snapshot: position -> record (None once deleted) for records in the snapshot,
+        # a plain list for records added since:
+        self.edited = {}
+        self.appended = []
+        # id -> position for records added since the snapshot, and ids deleted from the snapshot:
+        self.added_ids = {}
+        self.deleted_ids = set()
+        # Only built if the ids in the file aren't in order (hand-edited libraries):
+        self.id_positions = None
+
+    def close(self):
+        # The table views have to be released before the map can be closed:
+        for table in (self.offsets, self.ids):
+            if isinstance(table, memoryview):
+                table.release()
+        self.map.close()
+        self.snapshot_file.close()
+
+    def __len__(self):
+        return self.base_count + len(self.appended)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += len(self)
+        if position >= self.base_count:
+            return self.appended[position - self.base_count]
+        if position in self.edited:
+            return self.edited[position]
+        return decode_record(self.map, self.offsets[position])
+
+    def __setitem__(self, position, record):
+        if position >= self.base_count:
+            self.appended[position - self.base_count] = record
+        else:
+            self.edited[position] = record
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def append(self, record):
+        self.appended.append(record)
+
+    # Position of the record with record_id in the snapshot (KeyError if there is none):
+    def base_position(self, record_id):
+        if self.ascending:
+            position = bisect_left(self.ids, record_id)
+            if position < self.base_count and self.ids[position] == record_id:
+                return position
+            raise KeyError(record_id)
+        if self.id_positions is None:
+            self.id_positions = {record_id: position for position, record_id in enumerate(self.ids)}
+        return self.id_positions[record_id]
+
+    def position_of(self, record_id):
+        if record_id in self.added_ids:
+            return self.added_ids[record_id]
+        if record_id in self.deleted_ids:
+            raise KeyError(record_id)
+        return self.base_position(record_id)
+
+    def live_ids(self):
+        for position, record_id in enumerate(self.ids):
+            if record_id not in self.deleted_ids:
+                yield record_id
+        yield from self.added_ids
+
+    def max_id(self):
+        base_max = (self.ids[-1] if self.ascending else max(self.ids)) if self.base_count else -1
+        return max([base_max] + list(self.added_ids))
+
+    # Writes the current records to a new snapshot and maps that instead:
+    def rewrite(self, filename, backups=0, sync=True):
+        writer = BinarySnapshotWriter(filename, backups, sync)
+        write_records(writer, self)
+        writer.finish()
+        # The old file has to be unmapped before the new one replaces it (Windows won't replace a mapped file):
+        self.close()
+        tag = writer.replace()
+        self.filename = filename
+        self.load()
+        return tag
+
+# Library.positions (id -> position) for MappedContents:
+class MappedPositions:
+    def __init__(self, contents):
+        self.contents = contents
+
+    def __getitem__(self, record_id):
+        return self.contents.position_of(record_id)
+
+    def __setitem__(self, record_id, position):
+        self.contents.added_ids[record_id] = position
+
+    def __contains__(self, record_id):
+        try:
+            self.contents.position_of(record_id)
+        except KeyError:
+            return False
+        return True
+
+    def pop(self, record_id):
+        position = self.contents.position_of(record_id)
+        if record_id in self.contents.added_ids:
+            del self.contents.added_ids[record_id]
+        else:
+            self.contents.deleted_ids.add(record_id)
+        return position
+
+    def __iter__(self):
+        return self.contents.live_ids()
+
+    def __len__(self):
+        return self.contents.base_count - len(self.contents.deleted_ids) + len(self.contents.added_ids)
+
+# Library.records (id -> record) for MappedContents. Records are stored in the contents,
+# so setting and deleting entries here is left to Library.contents and Library.positions.
+class MappedRecords(MappedPositions):
+    def __getitem__(self, record_id):
+        return self.contents[self.contents.position_of(record_id)]
+
+    def __setitem__(self, record_id, record):
+        pass
+
+    def __delitem__(self, record_id):
+        pass
+
+    def get(self, record_id, default=None):
+        try:
+            return self[record_id]
+        except KeyError:
+            return default
+
+    def items(self):
+        for record_id in self:
+            yield record_id, self[record_id]
+
+    def values(self):
+        for record_id in self:
+            yield self[record_id]
+
+# Deleted records are left as None so positions stay valid while replaying.
+def apply_change(contents, positions, change):
+    if 'record' in change:
+        change['record'] = as_record(change['record'])
+    if change['op'] == 'insert':
+        positions[change['record']['_id']] = len(contents)
+        contents.append(change['record'])
+    # Journals written before records had ids refer to records by position:
+    elif 'index' in change:
+        if change['op'] == 'update':
+            contents[change['index']] = change['record']
+        else:
+            contents.pop(change['index'])
+    elif change['op'] == 'update':
+        contents[positions[change['id']]] = change['record']
+    elif change['op'] == 'delete':
+        contents[positions.pop(change['id'])] = None
+
+# Applies the journal (if any) to contents loaded from the snapshot identified by snapshot_tag.
+# positions (id -> position in contents) is built from contents unless given.
+def replay_journal(journal_filename, contents, snapshot_tag, positions=None):
+    try:
+        with open(journal_filename,'rb') as journal_file:
+            data = journal_file.read()
+    except FileNotFoundError:
+        return contents
+    # Anything after the last newline was cut short by a crash during append (or is still being
+    # written by another process) and isn't committed. append_journal() cleans it up under the lock.
+    complete = data.rfind(b'\n') + 1
+    lines = data[:complete].decode('utf8').splitlines()
+    if not lines:
+        return contents
+    header = json.loads(lines[0])
+    # A journal left over from before the last compaction has already been folded into the snapshot:
+    if header['snapshot'] != snapshot_tag:
+        return contents
+    if positions is None:
+        positions = {record.get('_id'): position for position, record in enumerate(contents)}
+    for line in lines[1:]:
+        apply_change(contents, positions, json.loads(line))
+    return contents
+
+# Appends changes to the journal. Unless sync is set they are only handed to the operating system,
+# which is quicker but may lose the latest commits (never earlier ones) in a power cut.
+# Must be called with the library locked.
+def append_journal(journal_filename, changes, snapshot_tag, sync=True):
+    with open(journal_filename,'a+b') as journal_file:
+        clean_journal(journal_file, snapshot_tag)
+        created = journal_file.tell() == 0
+        lines = [json.dumps(change,separators=(',',':'),default=json_default) for change in changes]
+        if created:
+            lines.insert(0, json.dumps({'snapshot':snapshot_tag}))
+        journal_file.write(('\n'.join(lines)+'\n').encode('utf8'))
+        journal_file.flush()
+        if sync:
+            os.fsync(journal_file.fileno())
+            if created:
+                fsync_directory(journal_filename)
+        return journal_file.tell()
+
+# Drops what replay_journal() ignores from an open journal: the whole journal if it belongs to an
+# older snapshot (left behind by a crash during compaction), or a last line cut short by a crash.
+# Leaves the file positioned at its end.
+def clean_journal(journal_file, snapshot_tag):
+    journal_file.seek(0)
+    header = journal_file.readline()
+    if not header.endswith(b'\n') or json.loads(header)['snapshot'] != snapshot_tag:
+        journal_file.truncate(0)
+    else:
+        journal_file.seek(-1, os.SEEK_END)
+        if journal_file.read(1) != b'\n':
+            journal_file.seek(0)
+            data = journal_file.read()
+            journal_file.truncate(data.rfind(b'\n') + 1)
+    journal_file.seek(0, os.SEEK_END)
+
+# Forces earlier unsynced appends out to disk:
+def sync_journal(journal_filename):
+    try:
+        with open(journal_filename,'r+b') as journal_file:
+            os.fsync(journal_file.fileno())
+    except FileNotFoundError:
+        return
+    fsync_directory(journal_filename)
+
+def remove_journal(journal_filename):
+    try:
+        os.remove(journal_filename)
+    except FileNotFoundError:
+        pass
+
+# Generation counters are kept in the lock file as a fixed-width decimal, so that they can be
+# rewritten in place without ever being half-written.
+GENERATION_FORMAT = b'%20d\n'
+
+def read_generation(lock_filename):
+    try:
+        with open(lock_filename,'rb') as lock_file:
+            data = lock_file.read()
+    except FileNotFoundError:
+        return 0
+    try:
+        return int(data or 0)
+    except ValueError:
+        return -1
+
+# Opens and locks the lock file (blocking until other writers are done). Close the file to unlock.
+def lock_library(lock_filename):
+    lock_file = os.fdopen(os.open(lock_filename, os.O_RDWR | os.O_CREAT), 'r+b')
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    return lock_file
+
+def locked_generation(lock_file):
+    lock_file.seek(0)
+    data = lock_file.read()
+    return int(data) if data.strip() else 0
+
+def set_generation(lock_file, generation):
+    lock_file.seek(0)
+    lock_file.write(GENERATION_FORMAT % generation)
+    lock_file.flush()